@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+
+def checkpoint_identifier(checkpoint_path: str | None) -> str:
+    """
+    Identify the weights of a model by the content of its checkpoint file
+    @param checkpoint_path: Path to the checkpoint file. None if the model is not loaded from a checkpoint
+    @return: Hex digest of the checkpoint file, empty if no checkpoint is provided
+    """
+    if checkpoint_path is None:
+        return ''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(checkpoint_path, 'rb') as checkpoint_file:
+        for chunk in iter(lambda: checkpoint_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def create_prediction_key(dataset_name: str, model_name: str, model_identifier: str, explained_event_id: int,
+                          candidate_events: np.ndarray, excluded_event_ids: np.ndarray,
+                          approximate_predictions: bool) -> bytes:
+    """
+    Derive the key under which a subgraph prediction is stored. The key is independent of the order in which the
+    excluded events were added to the counterfactual example
+    @param dataset_name: Name of the dataset
+    @param model_name: Name of the TGNN model
+    @param model_identifier: Identifier of the model weights (see checkpoint_identifier), so that predictions of a
+    retrained model with the same name are not reused
+    @param explained_event_id: ID of the explained event
+    @param candidate_events: Candidate events of the explained event
+    @param excluded_event_ids: IDs of the events that are excluded for the prediction
+    @param approximate_predictions: Whether the prediction is approximated
+    @return: Digest identifying the prediction
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{dataset_name}|{model_name}|{model_identifier}|{explained_event_id}|'
+                  f'{int(approximate_predictions)}|'.encode())
+    digest.update(np.ascontiguousarray(candidate_events, dtype=np.int64).tobytes())
+    digest.update(b'|')
+    digest.update(np.sort(np.asarray(excluded_event_ids, dtype=np.int64)).tobytes())
+    return digest.digest()
+
+
+class PredictionCache:
+    """
+    Cache for predictions on subgraphs that is shared across explainers and explanations. Recently used predictions are
+    held in memory; if a path is provided all predictions are additionally persisted in a sqlite database so that
+    repeated experiments can reuse them
+    """
+
+    def __init__(self, path: str | None = None, model_identifier: str = '', max_size: int = 100000,
+                 commit_interval: int = 1000):
+        """
+        @param path: Path to the sqlite database file. If None, predictions are only cached in memory
+        @param model_identifier: Identifier of the model weights whose predictions are cached (see
+        checkpoint_identifier)
+        @param max_size: Maximum number of predictions held in memory
+        @param commit_interval: Number of new predictions after which they are committed to the database
+        """
+        self.path = path
+        self.model_identifier = model_identifier
+        self.max_size = max_size
+        self.commit_interval = commit_interval
+        self.entries: OrderedDict[bytes, float] = OrderedDict()
+        self.uncommitted_entries = 0
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS predictions (key BLOB PRIMARY KEY, prediction REAL)')
+
+    def _remember(self, key: bytes, prediction: float):
+        self.entries[key] = prediction
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key: bytes) -> float | None:
+        """
+        Look up a prediction
+        @param key: Key of the prediction
+        @return: The cached prediction or None if the prediction is not cached
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.connection is None:
+            return None
+        row = self.connection.execute('SELECT prediction FROM predictions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self._remember(key, row[0])
+        return row[0]
+
+    def put(self, key: bytes, prediction: float):
+        """
+        Add a prediction to the cache
+        @param key: Key of the prediction
+        @param prediction: The prediction
+        """
+        self._remember(key, prediction)
+        if self.connection is not None:
+            self.connection.execute('INSERT OR REPLACE INTO predictions (key, prediction) VALUES (?, ?)',
+                                    (key, prediction))
+            self.uncommitted_entries += 1
+            if self.uncommitted_entries >= self.commit_interval:
+                self.flush()
+
+    def flush(self):
+        """
+        Commit all pending predictions to the database
+        """
+        if self.connection is not None:
+            self.connection.commit()
+            self.uncommitted_entries = 0
+
+    def close(self):
+        """
+        Commit all pending predictions and close the database connection
+        """
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
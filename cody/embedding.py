@@ -12,10 +12,13 @@ class Embedding:
     def __init__(self, dataset: ContinuousTimeDynamicGraphDataset, tgnn: TGNNWrapper):
         self.dataset = dataset
         self.tgnn = tgnn
+        # Static features are transferred to the model device once instead of on every embedding
+        self.node_features = torch.as_tensor(dataset.node_features, dtype=torch.float32, device=tgnn.device)
+        self.edge_features = torch.as_tensor(dataset.edge_features, dtype=torch.float32, device=tgnn.device)
 
     def get_double_embedding(self, event_ids: np.ndarray, explained_event_id: int):
         edge_embeddings, explained_edge_embedding = self.get_embeddings(event_ids, explained_event_id)
-        explained_edge_embeddings = torch.tile(explained_edge_embedding, (len(edge_embeddings), 1))
+        explained_edge_embeddings = explained_edge_embedding.unsqueeze(0).expand(len(edge_embeddings), -1)
         return torch.concatenate((edge_embeddings, explained_edge_embeddings), dim=1)
 
     def get_embeddings(self, event_ids: np.ndarray, explained_event_id: int):
@@ -23,14 +26,16 @@ class Embedding:
 
     def extract_static_features(self, event_ids: np.ndarray, explained_event_id: int):
         all_event_ids = np.concatenate([event_ids, np.array([explained_event_id])])
-        edge_mask = np.isin(self.dataset.edge_ids, all_event_ids)
-        involved_source_nodes = self.dataset.source_node_ids[edge_mask]
-        involved_target_nodes = self.dataset.target_node_ids[edge_mask]
+        # Event ids equal their index in the dataset, so the involved events are gathered directly in dataset order
+        #  instead of building a mask over all events of the dataset
+        event_indices = np.unique(all_event_ids)
+        involved_source_nodes = self.dataset.source_node_ids[event_indices]
+        involved_target_nodes = self.dataset.target_node_ids[event_indices]
 
-        source_node_features = self.dataset.node_features[involved_source_nodes]
-        target_node_features = self.dataset.node_features[involved_target_nodes]
-        edge_features = self.dataset.edge_features[edge_mask]
-        timestamp_embeddings = self.tgnn.encode_timestamps(self.dataset.timestamps[edge_mask])
+        source_node_features = self.node_features[torch.as_tensor(involved_source_nodes, device=self.tgnn.device)]
+        target_node_features = self.node_features[torch.as_tensor(involved_target_nodes, device=self.tgnn.device)]
+        edge_features = self.edge_features[torch.as_tensor(event_indices, device=self.tgnn.device)]
+        timestamp_embeddings = self.tgnn.encode_timestamps(self.dataset.timestamps[event_indices])
 
         return (source_node_features, target_node_features, edge_features, timestamp_embeddings, involved_source_nodes,
                 involved_target_nodes)
@@ -50,9 +55,7 @@ class StaticEmbedding(Embedding):
         (source_node_features, target_node_features, edge_features,
          timestamp_embeddings, _, _) = self.extract_static_features(event_ids, explained_event_id)
 
-        edge_embeddings = torch.cat((torch.tensor(source_node_features, dtype=torch.float32, device=self.tgnn.device),
-                                     torch.tensor(target_node_features, dtype=torch.float32, device=self.tgnn.device),
-                                     torch.tensor(edge_features, dtype=torch.float32, device=self.tgnn.device),
+        edge_embeddings = torch.cat((source_node_features, target_node_features, edge_features,
                                      timestamp_embeddings.squeeze()), dim=1)
 
         explained_edge_embedding = edge_embeddings[-1]
@@ -91,16 +94,10 @@ class DynamicEmbedding(Embedding):
                                                                             all_event_ids, negative_nodes=None)
 
         if self.embed_static_node_features:
-            edge_embeddings = torch.cat((source_embeddings, target_embeddings,
-                                         torch.tensor(source_node_features, dtype=torch.float32,
-                                                      device=self.tgnn.device),
-                                         torch.tensor(target_node_features, dtype=torch.float32,
-                                                      device=self.tgnn.device),
-                                         torch.tensor(edge_features, dtype=torch.float32, device=self.tgnn.device),
-                                         timestamp_embeddings.squeeze()), dim=1)
+            edge_embeddings = torch.cat((source_embeddings, target_embeddings, source_node_features,
+                                         target_node_features, edge_features, timestamp_embeddings.squeeze()), dim=1)
         else:
-            edge_embeddings = torch.cat((source_embeddings, target_embeddings,
-                                         torch.tensor(edge_features, dtype=torch.float32, device=self.tgnn.device),
+            edge_embeddings = torch.cat((source_embeddings, target_embeddings, edge_features,
                                          timestamp_embeddings.squeeze()), dim=1)
 
         explained_edge_embedding = edge_embeddings[-1]
@@ -1,12 +1,14 @@
 from __future__ import annotations
 
+import bisect
 import logging
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
 from dataclasses import dataclass
 
+from cody.cache import PredictionCache, create_prediction_key
 from cody.implementations.connector import TGNNWrapper
 from cody.constants import EXPLAINED_EVENT_MEMORY_LABEL, COL_ID
 from cody.data import SubgraphGenerator
@@ -39,20 +41,40 @@ class CounterFactualExample:
 
 
 class TreeNode:
+    __slots__ = ('edge_id', 'parent', 'depth', 'parent_ids', 'sorted_edge_ids', '_hash', 'original_prediction',
+                 'original_prediction_abs', 'prediction', 'is_counterfactual', 'expanded', 'max_expansion_reached',
+                 'children', 'exploitation_score')
     parent: TreeNode
+    depth: int
     children: List[TreeNode]
     is_counterfactual: bool
     edge_id: int
     prediction: float | None
     original_prediction: float
+    original_prediction_abs: float
     expanded: bool
     max_expansion_reached: bool
     exploitation_score: float
+    parent_ids: Tuple[int, ...]
+    sorted_edge_ids: Tuple[int, ...]
 
     def __init__(self, edge_id: int, parent: TreeNode | None, original_prediction: float):
         self.edge_id = edge_id
         self.parent = parent
+        if parent is None:
+            self.depth = 0
+            self.parent_ids = ()
+            self.sorted_edge_ids = ()
+        else:
+            self.depth = parent.depth + 1
+            self.parent_ids = (edge_id,) + parent.parent_ids
+            sorted_edge_ids = list(parent.sorted_edge_ids)
+            bisect.insort(sorted_edge_ids, edge_id)
+            self.sorted_edge_ids = tuple(sorted_edge_ids)
+        self._hash = None
         self.original_prediction = original_prediction
+        # Constant within a search tree -> computed once at the root and shared with all descendants
+        self.original_prediction_abs = abs(original_prediction) if parent is None else parent.original_prediction_abs
         self.prediction = None
         self.is_counterfactual = False
         self.expanded = False
@@ -60,19 +82,31 @@ class TreeNode:
         self.children = []
         self.exploitation_score = 0.0
 
+    def _calculate_exploitation_score(self) -> float:
+        """
+        Calculate the exploitation score of the node from its prediction, which is the prediction delta relative to the
+        original prediction and at least 0. The prediction delta is computed inline since this runs for every created
+        node
+        @return: The exploitation score
+        """
+        if self.prediction * self.original_prediction < 0:
+            prediction_delta = abs(self.prediction) + self.original_prediction_abs
+        else:
+            prediction_delta = self.original_prediction_abs - abs(self.prediction)
+        return max(0.0, prediction_delta / self.original_prediction_abs)
+
     def _check_max_expanded(self):
         """
-        Recursively check if the node is already maximally expanded, meaning that no further expansions of its child
-        nodes are possible
+        Check if the node and its ancestors are already maximally expanded, meaning that no further expansions of their
+        child nodes are possible
         """
-        if self.expanded:
-            if not self.max_expansion_reached:
-                for child in self.children:
-                    if not child.max_expansion_reached:
-                        return
-                self.max_expansion_reached = True
-            if self.parent is not None:
-                self.parent._check_max_expanded()
+        node = self
+        while node is not None and node.expanded:
+            if not node.max_expansion_reached:
+                if not all(child.max_expansion_reached for child in node.children):
+                    return
+                node.max_expansion_reached = True
+            node = node.parent
 
     def is_leaf(self) -> bool:
         """
@@ -89,8 +123,7 @@ class TreeNode:
         """
         self.prediction = prediction
         self.children.extend(children)
-        self.exploitation_score = max(0.0, (calculate_prediction_delta(self.original_prediction, self.prediction) /
-                                            abs(self.original_prediction)))
+        self.exploitation_score = self._calculate_exploitation_score()
         self.expanded = True
         if self.original_prediction * self.prediction < 0:
             self.is_counterfactual = True
@@ -121,38 +154,29 @@ class TreeNode:
         """
         Returns an instance of CounterFactualExample for the current node by aggregating information from parents
         """
-        cf_events = []
-        cf_event_importances = []
+        cf_events = np.empty(self.depth, dtype=np.int64)
+        cf_event_importances = np.empty(self.depth, dtype=np.float64)
         node = self
+        index = self.depth - 1
         while node.parent is not None:
-            cf_events.append(node.edge_id)
-            cf_event_importances.append(calculate_prediction_delta(self.original_prediction, node.prediction))
+            cf_events[index] = node.edge_id
+            cf_event_importances[index] = calculate_prediction_delta(self.original_prediction, node.prediction)
             node = node.parent
-        cf_events.reverse()
-        cf_event_importances.reverse()
+            index -= 1
         return CounterFactualExample(explained_event_id=node.edge_id,
                                      original_prediction=self.original_prediction,
                                      counterfactual_prediction=self.prediction,
                                      achieves_counterfactual_explanation=self.is_counterfactual,
-                                     event_ids=np.array(cf_events),
-                                     event_importances=np.array(cf_event_importances))
+                                     event_ids=cf_events,
+                                     event_importances=cf_event_importances)
 
     def get_parent_ids(self):
-        parent_ids = []
-        node = self
-        while node.parent is not None:
-            parent_ids.append(node.edge_id)
-            node = node.parent
-        return parent_ids
+        return list(self.parent_ids)
 
     def hash(self):
-        edge_ids = []
-        node = self
-        while node.parent is not None:
-            edge_ids.append(node.edge_id)
-            node = node.parent
-        sorted_edge_ids = sorted(edge_ids)
-        return '-'.join(map(str, sorted_edge_ids))
+        if self._hash is None:
+            self._hash = '-'.join(map(str, self.sorted_edge_ids))
+        return self._hash
 
 
 def calculate_prediction_delta(original_prediction: float, prediction_to_assess: float) -> float:
@@ -161,11 +185,26 @@ def calculate_prediction_delta(original_prediction: float, prediction_to_assess:
     return abs(original_prediction) - abs(prediction_to_assess)
 
 
+def calculate_prediction_deltas(original_prediction: float, predictions_to_assess: np.ndarray) -> np.ndarray:
+    """
+    Vectorized version of calculate_prediction_delta
+    @param original_prediction: Original prediction when considering all events
+    @param predictions_to_assess: Predictions to compare with the original prediction
+    @return: The prediction deltas for all provided predictions
+    """
+    absolute_predictions = np.abs(predictions_to_assess)
+    original_prediction_abs = abs(original_prediction)
+    return np.where(predictions_to_assess * original_prediction < 0,
+                    absolute_predictions + original_prediction_abs,
+                    original_prediction_abs - absolute_predictions)
+
+
 class Explainer:
 
     def __init__(self, tgnn_wrapper: TGNNWrapper, selection_strategy: str = 'recent', candidates_size: int = 75,
                  sample_size: int = 10, verbose: bool = False, approximate_predictions: bool = True,
-                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None):
+                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None,
+                 prediction_cache: PredictionCache | None = None):
         self.tgnn = tgnn_wrapper
         self.dataset = self.tgnn.dataset
         self.subgraph_generator = SubgraphGenerator(self.dataset)
@@ -178,6 +217,7 @@ class Explainer:
         self.verbose = verbose
         self.approximate_predictions = approximate_predictions
         self.pretrained_sampler_parameters = pretrained_sampler_parameters
+        self.prediction_cache = prediction_cache
 
     def _create_sampler(self, subgraph: pd.DataFrame, explained_event_id: int,
                         original_prediction: float) -> SelectionStrategy:
@@ -235,7 +275,8 @@ class Explainer:
     def calculate_subgraph_prediction(self, candidate_events: np.ndarray, cf_example_events: List[int],
                                       explained_event_id: int, candidate_event_id: int,
                                       original_prediction: float,
-                                      memory_label: str = EXPLAINED_EVENT_MEMORY_LABEL) -> float:
+                                      memory_label: str = EXPLAINED_EVENT_MEMORY_LABEL,
+                                      min_event_id: int | None = None) -> float:
         """
         Calculate the prediction score for the explained event, when excluding the candidate events
         @param candidate_events: Candidate events
@@ -244,11 +285,30 @@ class Explainer:
         @param candidate_event_id: ID of the currently investigated candidate event
         @param memory_label: Provide name of memory label if it should be different from the default
         @param original_prediction: Original prediction when considering all events
+        @param min_event_id: Event id up to which the memory is initialized. Defaults to one less than the lowest
+        candidate event id
         @return: Prediction when excluding the candidate events
         """
-        self.tgnn.initialize(np.min(candidate_events) - 1, show_progress=False,
-                             memory_label=memory_label)
         full_cf_example_events = np.array(cf_example_events + [candidate_event_id])
+        return self._calculate_prediction_excluding_events(candidate_events, full_cf_example_events,
+                                                           explained_event_id, original_prediction, memory_label,
+                                                           min_event_id)
+
+    def _calculate_prediction_excluding_events(self, candidate_events: np.ndarray,
+                                               full_cf_example_events: np.ndarray, explained_event_id: int,
+                                               original_prediction: float, memory_label: str,
+                                               min_event_id: int | None) -> float:
+        cache_key = None
+        if self.prediction_cache is not None:
+            cache_key = create_prediction_key(self.dataset.name, self.tgnn.name,
+                                              self.prediction_cache.model_identifier, explained_event_id,
+                                              candidate_events, full_cf_example_events, self.approximate_predictions)
+            cached_prediction = self.prediction_cache.get(cache_key)
+            if cached_prediction is not None:
+                return cached_prediction
+        if min_event_id is None:
+            min_event_id = np.min(candidate_events) - 1
+        self.tgnn.initialize(min_event_id, show_progress=False, memory_label=memory_label)
         event_ids_to_rollout = None
         if self.approximate_predictions:
             event_ids_to_rollout = candidate_events[~np.isin(candidate_events, full_cf_example_events)]
@@ -259,15 +319,50 @@ class Explainer:
                                                                              event_ids_to_rollout=event_ids_to_rollout)
         if original_prediction * subgraph_pred < 0 and self.approximate_predictions:
             # Approximated prediction is counterfactual -> Get the true score
-            self.tgnn.initialize(np.min(candidate_events) - 1, show_progress=False,
-                                 memory_label=memory_label)
+            self.tgnn.initialize(min_event_id, show_progress=False, memory_label=memory_label)
             subgraph_pred, _ = self.tgnn.compute_edge_probabilities_for_subgraph(explained_event_id,
                                                                                  full_cf_example_events,
                                                                                  result_as_logit=True,
                                                                                  event_ids_to_rollout=None)
         subgraph_pred = subgraph_pred.detach().cpu().item()
+        if cache_key is not None:
+            self.prediction_cache.put(cache_key, subgraph_pred)
         return subgraph_pred
 
+    def calculate_subgraph_predictions(self, candidate_events: np.ndarray, cf_example_events: List[int],
+                                       explained_event_id: int, candidate_event_ids: np.ndarray,
+                                       original_prediction: float,
+                                       memory_label: str = EXPLAINED_EVENT_MEMORY_LABEL,
+                                       stop_on_counterfactual: bool = False) -> np.ndarray:
+        """
+        Calculate the prediction scores for the explained event, when excluding the cf example events together with
+        each of the provided candidate event ids in turn. All predictions start from the same memory backup.
+        @param candidate_events: Candidate events
+        @param cf_example_events: Events to exclude
+        @param explained_event_id: ID of the explained event
+        @param candidate_event_ids: IDs of the candidate events that are investigated
+        @param original_prediction: Original prediction when considering all events
+        @param memory_label: Provide name of memory label if it should be different from the default
+        @param stop_on_counterfactual: If True, stop as soon as a counterfactual prediction is found. The returned array
+        then ends with the counterfactual prediction
+        @return: Predictions when excluding the candidate events, in the order of the candidate event ids
+        """
+        predictions = np.empty(len(candidate_event_ids), dtype=np.float64)
+        if len(candidate_event_ids) == 0:
+            return predictions
+        min_event_id = np.min(candidate_events) - 1
+        # The cf example events are shared by all predictions -> only the last entry changes per candidate
+        full_cf_example_events = np.empty(len(cf_example_events) + 1, dtype=np.int64)
+        full_cf_example_events[:-1] = cf_example_events
+        for index, candidate_event_id in enumerate(candidate_event_ids):
+            full_cf_example_events[-1] = candidate_event_id
+            predictions[index] = self._calculate_prediction_excluding_events(candidate_events, full_cf_example_events,
+                                                                             explained_event_id, original_prediction,
+                                                                             memory_label, min_event_id)
+            if stop_on_counterfactual and predictions[index] * original_prediction < 0:
+                return predictions[:index + 1]
+        return predictions
+
     def explain(self, explained_event_id: int) -> CounterFactualExample:
         """
         Explain the provided event
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+import math
 import sys
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 
+from cody.cache import PredictionCache
 from cody.implementations.connector import TGNNWrapper
 from cody.constants import EXPLAINED_EVENT_MEMORY_LABEL, COL_ID
 from cody.explainer.base import Explainer, CounterFactualExample, calculate_prediction_delta, TreeNode
@@ -13,21 +15,25 @@ from cody.selection import PretrainedSelectionStrategyParameters, SelectionStrat
 
 def find_best_non_counterfactual_example(root_node: CoDyTreeNode) -> CoDyTreeNode:
     """
-        Breadth-first search for explanation that comes closest to counterfactual example
+        Search the tree for the explanation that comes closest to a counterfactual example
     """
     best_example = root_node
-    nodes_to_visit = root_node.children.copy()
-    while len(nodes_to_visit) != 0:
+    best_delta = calculate_prediction_delta(root_node.original_prediction, root_node.prediction)
+    nodes_to_visit = list(root_node.children)
+    while nodes_to_visit:
         explored_node = nodes_to_visit.pop()
         if explored_node.prediction is not None:
-            if (calculate_prediction_delta(best_example.original_prediction, best_example.prediction) <
-                    calculate_prediction_delta(explored_node.original_prediction, explored_node.prediction)):
+            delta = calculate_prediction_delta(explored_node.original_prediction, explored_node.prediction)
+            if best_delta < delta:
                 best_example = explored_node
-        nodes_to_visit.extend(explored_node.children.copy())
+                best_delta = delta
+        nodes_to_visit.extend(explored_node.children)
     return best_example
 
 
 class CoDyTreeNode(TreeNode):
+    __slots__ = ('sampling_rank', 'number_of_selections', 'alpha', 'beta', 'children_weighted_score_sum',
+                 'children_selections_sum', 'weighted_score_contribution', 'selections_contribution')
     parent: CoDyTreeNode
     children: List[CoDyTreeNode]
     number_of_selections: int
@@ -43,16 +49,20 @@ class CoDyTreeNode(TreeNode):
         self.number_of_selections: int = 1
         self.alpha = alpha
         self.beta = beta
-        if self.parent is None:
-            self.depth = 0
-        else:
-            self.depth = self.parent.depth + 1
+        # Sums over the expanded children that enter the exploitation score, and this node's share in the parent's sums
+        self.children_weighted_score_sum = 0.0
+        self.children_selections_sum = 0
+        self.weighted_score_contribution = 0.0
+        self.selections_contribution = 0
 
-    def _calculate_score(self):
+    def _calculate_score(self, parent_log_selections: float | None = None):
         """
         Calculate the search score which balances exploration with exploitation
+        @param parent_log_selections: Logarithm of the parent's number of selections, computed if not provided
         """
-        exploration_score = np.sqrt(np.log(self.parent.number_of_selections) / self.number_of_selections)
+        if parent_log_selections is None:
+            parent_log_selections = math.log(self.parent.number_of_selections)
+        exploration_score = math.sqrt(parent_log_selections / self.number_of_selections)
         return self.alpha * self.exploitation_score + self.beta * exploration_score
 
     def select_next_leaf(self, max_depth: int) -> CoDyTreeNode:
@@ -61,40 +71,49 @@ class CoDyTreeNode(TreeNode):
         @param max_depth: Maximum depth at which to search for leaf nodes
         @return: Leaf node to expand
         """
-        if self.is_leaf():
-            return self
-        if self.depth == max_depth:
-            self.max_expansion_reached = True
-            if self.parent is not None:
-                self.parent._check_max_expanded()
-                return self.parent.select_next_leaf(max_depth)
-        selected_child = None
-        best_score = 0
-        candidate_children = [child for child in self.children if not (child.is_counterfactual or
-                                                                       child.max_expansion_reached)]
-        if max_depth == self.depth - 1:
-            # If max depth is reached in the next level only consider children that can be directly expanded, otherwise
-            #  the max depth requirement would be violated
-            for child in self.children:
-                child.max_expansion_reached = True
-            candidate_children = [child for child in self.children if not child.expanded]
-        for child in candidate_children:
-            child_score = child._calculate_score()
-            if child_score > best_score:
-                best_score = child_score
-                selected_child = child
-        if selected_child is None:  # This means that there are no candidate children -> return oneself
-            if self.expanded and self.parent is not None:
-                self.max_expansion_reached = True
-                self.parent._check_max_expanded()  # When no selection is possible the node is fully expanded
-                return self.parent.select_next_leaf(max_depth)
-            return self
-        if not selected_child.expanded:
-            # If a node that has not yet been expanded is selected then select the node from the unexpanded children
-            # with the lowest sampling rank
-            unexpanded_children = [child for child in self.children if not child.expanded]
-            selected_child = min(unexpanded_children, key=lambda node: node.sampling_rank)
-        return selected_child.select_next_leaf(max_depth)
+        node = self
+        while True:
+            if node.is_leaf():
+                return node
+            if node.depth == max_depth:
+                node.max_expansion_reached = True
+                if node.parent is not None:
+                    node.parent._check_max_expanded()
+                    node = node.parent
+                    continue
+            selected_child = None
+            best_score = 0
+            lowest_rank_unexpanded_child = None
+            # If max depth is reached in the next level only consider children that can be directly expanded,
+            #  otherwise the max depth requirement would be violated
+            max_depth_in_next_level = (max_depth == node.depth - 1)
+            parent_log_selections = math.log(node.number_of_selections)
+            for child in node.children:
+                if max_depth_in_next_level:
+                    child.max_expansion_reached = True
+                    is_candidate = not child.expanded
+                else:
+                    is_candidate = not (child.is_counterfactual or child.max_expansion_reached)
+                if not child.expanded and (lowest_rank_unexpanded_child is None or
+                                           child.sampling_rank < lowest_rank_unexpanded_child.sampling_rank):
+                    lowest_rank_unexpanded_child = child
+                if is_candidate:
+                    child_score = child._calculate_score(parent_log_selections)
+                    if child_score > best_score:
+                        best_score = child_score
+                        selected_child = child
+            if selected_child is None:  # This means that there are no candidate children -> return the node itself
+                if node.expanded and node.parent is not None:
+                    node.max_expansion_reached = True
+                    node.parent._check_max_expanded()  # When no selection is possible the node is fully expanded
+                    node = node.parent
+                    continue
+                return node
+            if not selected_child.expanded:
+                # If a node that has not yet been expanded is selected then select the node from the unexpanded
+                # children with the lowest sampling rank
+                selected_child = lowest_rank_unexpanded_child
+            node = selected_child
 
     def expansion_backpropagation(self):
         """
@@ -102,20 +121,19 @@ class CoDyTreeNode(TreeNode):
         """
         self.number_of_selections += 1
         if not self.is_leaf():
-            if len(self.children) > 0:
-                self.exploitation_score = max(0.0,
-                                              (calculate_prediction_delta(self.original_prediction, self.prediction) /
-                                               abs(self.original_prediction)))
-                expanded_children = [child for child in self.children if child.expanded]
-                if len(expanded_children) > 0:
-                    selections_counter = self.number_of_selections
-                    self.exploitation_score = self.exploitation_score * self.number_of_selections
-                    for child in expanded_children:
-                        self.exploitation_score += child.exploitation_score * child.number_of_selections
-                        selections_counter += child.number_of_selections
-                    self.exploitation_score = self.exploitation_score / selections_counter
+            self.exploitation_score = self._calculate_exploitation_score()
+            if self.children_selections_sum > 0:
+                self.exploitation_score = ((self.exploitation_score * self.number_of_selections +
+                                            self.children_weighted_score_sum) /
+                                           (self.number_of_selections + self.children_selections_sum))
 
         if self.parent is not None:
+            if self.expanded:
+                weighted_score = self.exploitation_score * self.number_of_selections
+                self.parent.children_weighted_score_sum += weighted_score - self.weighted_score_contribution
+                self.parent.children_selections_sum += self.number_of_selections - self.selections_contribution
+                self.weighted_score_contribution = weighted_score
+                self.selections_contribution = self.number_of_selections
             self.parent.expansion_backpropagation()
 
 
@@ -124,18 +142,31 @@ class CoDy(Explainer):
     def __init__(self, tgnn_wrapper: TGNNWrapper, candidates_size: int = 75, selection_strategy: str = 'recent',
                  max_steps: int = 200, verbose: bool = False, approximate_predictions: bool = True,
                  pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None, alpha: float = 2.0,
-                 beta: float = 1.0):
+                 beta: float = 1.0, prediction_cache: PredictionCache | None = None, early_stop: bool = False):
         super().__init__(tgnn_wrapper, selection_strategy, candidates_size=candidates_size, sample_size=candidates_size,
                          verbose=verbose, approximate_predictions=approximate_predictions,
-                         pretrained_sampler_parameters=pretrained_sampler_parameters)
+                         pretrained_sampler_parameters=pretrained_sampler_parameters,
+                         prediction_cache=prediction_cache)
         self.max_steps = max_steps
         self.known_states = {}
+        self.known_states_index = {}
         self.alpha = alpha
         self.beta = beta
+        self.early_stop = early_stop
+
+    def _should_stop_early(self, best_cf_example: CoDyTreeNode | None) -> bool:
+        """
+        Check if the search should be stopped before reaching the maximum number of steps. Only applies if early
+        stopping is enabled
+        @param best_cf_example: The best counterfactual example found so far
+        @return: True if the best counterfactual example is already minimal, meaning that no counterfactual example
+        with fewer events can be found
+        """
+        return self.early_stop and best_cf_example is not None and best_cf_example.depth <= 1
 
     def _run_node_expansion(self, explained_edge_id: int, node_to_expand: CoDyTreeNode, sampler: SelectionStrategy):
         edge_ids_to_exclude = node_to_expand.get_parent_ids()
-        prediction = self.calculate_subgraph_prediction(candidate_events=sampler.subgraph[COL_ID].to_numpy(),
+        prediction = self.calculate_subgraph_prediction(candidate_events=sampler.event_ids,
                                                         cf_example_events=edge_ids_to_exclude,
                                                         explained_event_id=explained_edge_id,
                                                         candidate_event_id=node_to_expand.edge_id,
@@ -144,9 +175,25 @@ class CoDy(Explainer):
 
         self._expand_node(explained_edge_id, node_to_expand, prediction, sampler)
 
+    def _add_known_state(self, sorted_edge_ids: Tuple[int, ...], prediction: float):
+        """
+        Remember the prediction for a combination of excluded events. The index maps each combination with one event
+        less to the events that complete it to a known combination
+        """
+        self.known_states[sorted_edge_ids] = prediction
+        for index, edge_id in enumerate(sorted_edge_ids):
+            sub_combination = sorted_edge_ids[:index] + sorted_edge_ids[index + 1:]
+            self.known_states_index.setdefault(sub_combination, set()).add(edge_id)
+
+    def _reset_known_states(self):
+        # Known states are keyed by the excluded events only and are thus only valid for one explained event; use a
+        # PredictionCache to reuse predictions across explanations
+        self.known_states = {}
+        self.known_states_index = {}
+
     def _expand_node(self, explained_edge_id: int, node_to_expand: CoDyTreeNode, prediction: float,
                      sampler: SelectionStrategy):
-        self.known_states[node_to_expand.hash()] = prediction
+        self._add_known_state(node_to_expand.sorted_edge_ids, prediction)
 
         if node_to_expand.is_counterfactual:
             node_to_expand.expand(prediction, [])
@@ -161,9 +208,13 @@ class CoDy(Explainer):
                                      alpha=self.alpha, beta=self.beta)
             children.append(new_child)
         node_to_expand.expand(prediction, children)
+        known_child_edge_ids = self.known_states_index.get(node_to_expand.sorted_edge_ids)
+        if known_child_edge_ids is None:
+            return
         for new_child in children:
-            if new_child.hash() in self.known_states.keys():
-                self._expand_node(explained_edge_id, new_child, self.known_states[new_child.hash()], sampler)
+            if new_child.edge_id in known_child_edge_ids:
+                self._expand_node(explained_edge_id, new_child, self.known_states[new_child.sorted_edge_ids],
+                                  sampler)
 
     def explain(self, explained_event_id: int) -> CounterFactualExample:
         """
@@ -206,10 +257,10 @@ class CoDy(Explainer):
                     continue
                 if node_to_expand == root_node and root_node.expanded:
                     break  # No nodes are selectable, meaning that we can conclude the search
-                if node_to_expand.hash() in self.known_states.keys():
+                if node_to_expand.sorted_edge_ids in self.known_states:
                     # Already encountered this combination -> select new combination of events instead
-                    self._expand_node(explained_event_id, node_to_expand, self.known_states[node_to_expand.hash()],
-                                      sampler)
+                    self._expand_node(explained_event_id, node_to_expand,
+                                      self.known_states[node_to_expand.sorted_edge_ids], sampler)
                     node_to_expand = None
             if node_to_expand == root_node and root_node.expanded:
                 if self.verbose:
@@ -228,10 +279,14 @@ class CoDy(Explainer):
                 max_depth = best_cf_example.depth
                 if self.verbose:
                     self.logger.info(f'Found counterfactual explanation: ' + str(node_to_expand.to_cf_example()))
+            if self._should_stop_early(best_cf_example):
+                if self.verbose:
+                    self.logger.info('Best counterfactual explanation is minimal. Concluding search.')
+                break
             step += 1
         if best_cf_example is None:
             best_cf_example = find_best_non_counterfactual_example(root_node)
         self.tgnn.remove_memory_backup(EXPLAINED_EVENT_MEMORY_LABEL)
         self.tgnn.reset_model()
-        self.known_states = {}
+        self._reset_known_states()
         return best_cf_example.to_cf_example()
@@ -1,19 +1,22 @@
 import sys
 
 import numpy as np
-from cody.constants import COL_ID, EXPLAINED_EVENT_MEMORY_LABEL, CUR_IT_MIN_EVENT_MEM_LBL
-from cody.explainer.base import Explainer, CounterFactualExample, calculate_prediction_delta, TreeNode
+from cody.constants import EXPLAINED_EVENT_MEMORY_LABEL, CUR_IT_MIN_EVENT_MEM_LBL
+from cody.explainer.base import Explainer, CounterFactualExample, calculate_prediction_deltas, TreeNode
 from cody.selection import LocalGradientSelectionStrategy
 
 
 class GreedyTreeNode(TreeNode):
+    __slots__ = ('children_exploitation_scores',)
 
-    def __init__(self, edge_id: int, parent: TreeNode | None, original_prediction: float, prediction: float):
+    def __init__(self, edge_id: int, parent: TreeNode | None, original_prediction: float, prediction: float,
+                 exploitation_score: float | None = None):
         super().__init__(edge_id, parent, original_prediction)
         self.prediction: float = prediction
-        self.exploitation_score: float = max(0.0,
-                                             (calculate_prediction_delta(self.original_prediction, self.prediction) /
-                                              abs(self.original_prediction)))
+        if exploitation_score is None:
+            exploitation_score = self._calculate_exploitation_score()
+        self.exploitation_score: float = exploitation_score
+        self.children_exploitation_scores: np.ndarray = np.empty(0)
         if self.original_prediction * self.prediction < 0:
             self.is_counterfactual = True
             self.max_expansion_reached = True
@@ -21,17 +24,25 @@ class GreedyTreeNode(TreeNode):
     def select_next_leaf(self, max_depth: int) -> TreeNode | None:
         if not self.expanded:
             return self
-        best_child = None
-        for child in self.children:
-            if child.exploitation_score > self.exploitation_score:
-                if best_child is None:
-                    best_child = child
-                elif child.exploitation_score > best_child.exploitation_score:
-                    best_child = child
-        if best_child is not None:
-            return best_child.select_next_leaf(max_depth)
+        if len(self.children_exploitation_scores) == 0:
+            return None
+        best_index = int(np.argmax(self.children_exploitation_scores))
+        if self.children_exploitation_scores[best_index] > self.exploitation_score:
+            return self.children[best_index].select_next_leaf(max_depth)
         return None
 
+    def mark_expanded(self, children_exploitation_scores: np.ndarray | None = None):
+        """
+        Mark the node as expanded and store the exploitation scores of its children for the selection of the next leaf
+        @param children_exploitation_scores: Exploitation scores of the children in the order of the children. Derived
+        from the children if not provided
+        """
+        if children_exploitation_scores is None:
+            children_exploitation_scores = np.fromiter((child.exploitation_score for child in self.children),
+                                                        dtype=np.float64, count=len(self.children))
+        self.children_exploitation_scores = children_exploitation_scores
+        self.expanded = True
+
     def expansion_backpropagation(self):
         pass
 
@@ -40,7 +51,7 @@ class GreedyCFExplainer(Explainer):
 
     def explain(self, explained_event_id: int) -> CounterFactualExample:
         original_prediction, sampler = self.initialize_explanation(explained_event_id)
-        min_event_id = sampler.subgraph[COL_ID].min() - 1
+        min_event_id = sampler.min_event_id
         root_node = GreedyTreeNode(explained_event_id, None, original_prediction=original_prediction,
                                    prediction=original_prediction)
         max_depth = sys.maxsize
@@ -49,7 +60,7 @@ class GreedyCFExplainer(Explainer):
 
         if type(sampler) is LocalGradientSelectionStrategy:
             for child_id in sampler.rank_subgraph(base_event_id=explained_event_id, excluded_events=np.array([])):
-                prediction = self.calculate_subgraph_prediction(candidate_events=sampler.subgraph[COL_ID].to_numpy(),
+                prediction = self.calculate_subgraph_prediction(candidate_events=sampler.event_ids,
                                                                 cf_example_events=[],
                                                                 explained_event_id=explained_event_id,
                                                                 candidate_event_id=child_id,
@@ -68,7 +79,7 @@ class GreedyCFExplainer(Explainer):
                 sampler.set_event_weight(child_node.edge_id, child_node.exploitation_score)
             if best_cf_example is not None:
                 return best_cf_example.to_cf_example()
-            root_node.expanded = True
+            root_node.mark_expanded()
 
         i = 0
         while True:
@@ -85,26 +96,29 @@ class GreedyCFExplainer(Explainer):
                                               size=self.sample_size)
             self.tgnn.initialize(min_event_id, show_progress=False,
                                  memory_label=EXPLAINED_EVENT_MEMORY_LABEL)
-            for candidate_event_id in sampled_edge_ids:
-                prediction = self.calculate_subgraph_prediction(candidate_events=sampled_edge_ids,
-                                                                cf_example_events=node_to_expand.get_parent_ids() +
-                                                                                  [node_to_expand.edge_id],
-                                                                explained_event_id=explained_event_id,
-                                                                candidate_event_id=candidate_event_id,
-                                                                original_prediction=original_prediction,
-                                                                memory_label=CUR_IT_MIN_EVENT_MEM_LBL)
+            # Scoring stops at the first counterfactual, remaining candidates would only waste oracle calls
+            predictions = self.calculate_subgraph_predictions(candidate_events=sampled_edge_ids,
+                                                              cf_example_events=node_to_expand.get_parent_ids() +
+                                                                                [node_to_expand.edge_id],
+                                                              explained_event_id=explained_event_id,
+                                                              candidate_event_ids=sampled_edge_ids,
+                                                              original_prediction=original_prediction,
+                                                              memory_label=CUR_IT_MIN_EVENT_MEM_LBL,
+                                                              stop_on_counterfactual=True)
+            exploitation_scores = np.maximum(0.0, calculate_prediction_deltas(original_prediction, predictions) /
+                                             node_to_expand.original_prediction_abs)
+            for candidate_event_id, prediction, exploitation_score in zip(sampled_edge_ids, predictions.tolist(),
+                                                                          exploitation_scores.tolist()):
                 child_node = GreedyTreeNode(candidate_event_id, parent=node_to_expand,
-                                            original_prediction=original_prediction, prediction=prediction)
+                                            original_prediction=original_prediction, prediction=prediction,
+                                            exploitation_score=exploitation_score)
                 node_to_expand.children.append(child_node)
                 if child_node.is_counterfactual:
-                    if best_cf_example is None:
-                        best_cf_example = child_node
-                    elif best_cf_example.exploitation_score < child_node.exploitation_score:
-                        best_cf_example = child_node
+                    best_cf_example = child_node
                     if self.verbose:
                         self.logger.info(f'Found counterfactual explanation: ' + str(child_node.to_cf_example()))
             self.tgnn.remove_memory_backup(CUR_IT_MIN_EVENT_MEM_LBL)
-            node_to_expand.expanded = True
+            node_to_expand.mark_expanded(exploitation_scores)
             if best_cf_example is not None:
                 break
             i += 1
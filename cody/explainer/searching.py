@@ -1,25 +1,27 @@
 from __future__ import annotations
 
+import math
 import sys
 from typing import List
 
 import numpy as np
 
+from cody.cache import PredictionCache
 from cody.implementations.connector import TGNNWrapper
 from cody.explainer.base import Explainer, calculate_prediction_delta, TreeNode
 from cody.selection import SelectionStrategy, PretrainedSelectionStrategyParameters
-from cody.constants import CUR_IT_MIN_EVENT_MEM_LBL, EXPLAINED_EVENT_MEMORY_LABEL, COL_ID
+from cody.constants import CUR_IT_MIN_EVENT_MEM_LBL, EXPLAINED_EVENT_MEMORY_LABEL
+
+SQRT_2 = math.sqrt(2)
 
 
 def select_best_cf_example(current_best_example: BatchSearchTreeNode | None,
                            candidate_examples: List[BatchSearchTreeNode]) -> BatchSearchTreeNode:
-    sorted_candidates = sorted(candidate_examples, key=lambda node: node.depth)
-    min_depth = sorted_candidates[0].depth
+    min_depth = min(candidate.depth for candidate in candidate_examples)
     if current_best_example is not None and min_depth > current_best_example.depth:
         return current_best_example
-    min_depth_candidates = [candidate for candidate in candidate_examples if candidate.depth == min_depth]
-    sorted_min_depth_candidates = sorted(min_depth_candidates, key=lambda node: node.exploitation_score, reverse=True)
-    best_candidate = sorted_min_depth_candidates[0]
+    best_candidate = max((candidate for candidate in candidate_examples if candidate.depth == min_depth),
+                         key=lambda node: node.exploitation_score)
     if current_best_example is None:
         return best_candidate
     if (min_depth < current_best_example.depth or
@@ -34,19 +36,22 @@ def find_best_non_counterfactual_example(root_node: BatchSearchTreeNode) -> Batc
         Breadth-first search for explanation that comes closest to counterfactual example
     """
     best_example = root_node
-    nodes_to_visit = root_node.children
-    while len(nodes_to_visit) != 0:
+    best_delta = calculate_prediction_delta(root_node.original_prediction, root_node.prediction)
+    nodes_to_visit = list(root_node.children)
+    while nodes_to_visit:
         explored_node = nodes_to_visit.pop()
         if explored_node.is_leaf():
-            if (calculate_prediction_delta(best_example.original_prediction, best_example.prediction) <
-                    calculate_prediction_delta(explored_node.original_prediction, explored_node.prediction)):
+            delta = calculate_prediction_delta(explored_node.original_prediction, explored_node.prediction)
+            if best_delta < delta:
                 best_example = explored_node
+                best_delta = delta
         else:
             nodes_to_visit.extend(explored_node.children)
     return best_example
 
 
 class BatchSearchTreeNode(TreeNode):
+    __slots__ = ('number_of_selections', 'children_exploitation_score_sum')
     parent: BatchSearchTreeNode
     children: List[BatchSearchTreeNode]
     score: float
@@ -57,37 +62,26 @@ class BatchSearchTreeNode(TreeNode):
     def __init__(self, edge_id: int, parent: BatchSearchTreeNode | None, prediction: float, original_prediction: float):
         super().__init__(edge_id, parent, original_prediction)
         self.prediction: float = prediction
-        self.exploitation_score: float = max(0.0,
-                                             (calculate_prediction_delta(self.original_prediction, self.prediction) /
-                                              abs(self.original_prediction)))
+        self.exploitation_score: float = self._calculate_exploitation_score()
         self.number_of_selections: int = 1
-        depth = 0
-        parent = self.parent
-        while parent is not None:
-            depth += 1
-            parent = parent.parent
-        self.depth = depth
+        self.children_exploitation_score_sum = 0.0
+        if self.parent is not None:
+            # Nodes are always added as children of their parent upon creation
+            self.parent.children_exploitation_score_sum += self.exploitation_score
         self.max_expansion_reached = self.is_counterfactual  # Counterfactual nodes are always fully expanded
 
     def _check_max_expanded(self):
         """
-        Recursively check if the node is already maximally expanded, meaning that no further expansions of its child
-        nodes are possible
+        Check if the node and its ancestors are already maximally expanded, meaning that no further expansions of their
+        child nodes are possible
         """
-        if not self.max_expansion_reached:
-            for child in self.children:
+        node = self
+        while node is not None and not node.max_expansion_reached:
+            for child in node.children:
                 if not child.max_expansion_reached or child.expanded:
                     return
-            self.max_expansion_reached = True
-            if self.parent is not None:
-                self.parent._check_max_expanded()
-
-    def _calculate_score(self):
-        """
-        Calculate the search score which balances exploration with exploitation
-        """
-        exploration_score = np.sqrt(2) * np.sqrt(np.log(self.parent.number_of_selections) / self.number_of_selections)
-        return self.exploitation_score + exploration_score
+            node.max_expansion_reached = True
+            node = node.parent
 
     def select_next_leaf(self, max_depth: int) -> BatchSearchTreeNode:
         """
@@ -95,38 +89,59 @@ class BatchSearchTreeNode(TreeNode):
         @param max_depth: Maximum depth at which to search for leaf nodes
         @return: Leaf node to expand
         """
-        if self.is_leaf() or self.depth == max_depth:
-            return self
-        selected_child = None
-        best_score = 0
-        candidate_children = [child for child in self.children if not (child.is_counterfactual or
-                                                                       child.max_expansion_reached)]
-        if max_depth == self.depth - 1:
-            # If max depth is reached in the next level only consider children that can be directly expanded, otherwise
-            #  the max depth requirement would be violated
-            candidate_children = [child for child in self.children if child.is_leaf()]
-        for child in candidate_children:
-            child_score = child._calculate_score()
-            if child_score > best_score:
-                best_score = child_score
-                selected_child = child
-        if selected_child is None:  # This means that there are no candidate children -> return oneself
-            if self.expanded:
-                self._check_max_expanded()  # When no selection is possible the node is fully expanded
-            return self
-        return selected_child.select_next_leaf(max_depth)
+        node = self
+        while not (node.is_leaf() or node.depth == max_depth):
+            selected_child = None
+            number_of_children = len(node.children)
+            if max_depth == node.depth - 1:
+                # If max depth is reached in the next level only consider children that can be directly expanded,
+                #  otherwise the max depth requirement would be violated
+                candidate_mask = np.fromiter((child.is_leaf() for child in node.children), dtype=bool,
+                                             count=number_of_children)
+            else:
+                candidate_mask = np.fromiter((not (child.is_counterfactual or child.max_expansion_reached)
+                                              for child in node.children), dtype=bool, count=number_of_children)
+            candidate_indices = np.flatnonzero(candidate_mask)
+            if len(candidate_indices) == 1:
+                # A single candidate is scored with scalar math instead of going through numpy arrays
+                child = node.children[candidate_indices[0]]
+                score = child.exploitation_score + SQRT_2 * math.sqrt(math.log(node.number_of_selections) /
+                                                                      child.number_of_selections)
+                if score > 0:
+                    selected_child = child
+            elif len(candidate_indices) > 1:
+                # Only the candidates are scored, which near the max depth are typically few of the children
+                candidates = [node.children[index] for index in candidate_indices]
+                exploitation_scores = np.fromiter((child.exploitation_score for child in candidates),
+                                                  dtype=np.float64, count=len(candidates))
+                selections = np.fromiter((child.number_of_selections for child in candidates), dtype=np.float64,
+                                         count=len(candidates))
+                scores = exploitation_scores + SQRT_2 * np.sqrt(math.log(node.number_of_selections) / selections)
+                best_index = int(np.argmax(scores))
+                if scores[best_index] > 0:
+                    selected_child = candidates[best_index]
+            if selected_child is None:  # This means that there are no candidate children -> return the node itself
+                if node.expanded:
+                    node._check_max_expanded()  # When no selection is possible the node is fully expanded
+                return node
+            node = selected_child
+        return node
 
     def selection_backpropagation(self):
         """
         Propagate the information that a node is selected backwards and update scores
         """
-        if not self.is_leaf():
-            avg_exploitation_score = sum(child.exploitation_score for child in self.children) / len(self.children)
-            # TODO: Assess if this should be max or just the avg or if the best score should be propagated backwards
-            self.exploitation_score = max(self.exploitation_score, avg_exploitation_score)
-        self.number_of_selections += 1
-        if self.parent is not None:
-            self.parent.selection_backpropagation()
+        node = self
+        while node is not None:
+            if not node.is_leaf():
+                avg_exploitation_score = node.children_exploitation_score_sum / len(node.children)
+                # TODO: Assess if this should be max or just the avg or if the best score should be propagated backwards
+                exploitation_score = max(node.exploitation_score, avg_exploitation_score)
+                if node.parent is not None:
+                    node.parent.children_exploitation_score_sum += exploitation_score - node.exploitation_score
+                node.exploitation_score = exploitation_score
+            node.number_of_selections += 1
+            node = node.parent
 
 
 class SearchingCFExplainer(Explainer):
@@ -134,10 +149,12 @@ class SearchingCFExplainer(Explainer):
     def __init__(self, tgnn_wrapper: TGNNWrapper, candidates_size: int = 75, sample_size: int = 10,
                  selection_strategy: str = 'recent', max_steps: int = 50, verbose: bool = False,
                  approximate_predictions: bool = True,
-                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None):
+                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None,
+                 prediction_cache: PredictionCache | None = None):
         super().__init__(tgnn_wrapper, selection_strategy, candidates_size=candidates_size, sample_size=sample_size,
                          verbose=verbose, approximate_predictions=approximate_predictions,
-                         pretrained_sampler_parameters=pretrained_sampler_parameters)
+                         pretrained_sampler_parameters=pretrained_sampler_parameters,
+                         prediction_cache=prediction_cache)
         self.max_steps = max_steps
 
     def expand_node(self, explained_edge_id: int, node_to_expand: BatchSearchTreeNode, sampler: SelectionStrategy,
@@ -154,16 +171,16 @@ class SearchingCFExplainer(Explainer):
             self.logger.info(f'Selected node {str(node_to_expand.edge_id)} and excluded edge ids '
                              f'{str(edge_ids_to_exclude)}')
         if len(sampled_edge_ids) > 0:
-            min_event_id = sampler.subgraph[COL_ID].min() - 1
+            min_event_id = sampler.min_event_id
             self.tgnn.initialize(min_event_id, show_progress=False,
                                  memory_label=EXPLAINED_EVENT_MEMORY_LABEL)
-        for edge_id in sampled_edge_ids:
-            prediction = self.calculate_subgraph_prediction(candidate_events=sampled_edge_ids,
-                                                            cf_example_events=edge_ids_to_exclude,
-                                                            explained_event_id=explained_edge_id,
-                                                            candidate_event_id=edge_id,
-                                                            original_prediction=original_prediction,
-                                                            memory_label=CUR_IT_MIN_EVENT_MEM_LBL)
+        predictions = self.calculate_subgraph_predictions(candidate_events=sampled_edge_ids,
+                                                         cf_example_events=edge_ids_to_exclude,
+                                                         explained_event_id=explained_edge_id,
+                                                         candidate_event_ids=sampled_edge_ids,
+                                                         original_prediction=original_prediction,
+                                                         memory_label=CUR_IT_MIN_EVENT_MEM_LBL)
+        for edge_id, prediction in zip(sampled_edge_ids, predictions.tolist()):
             new_child = BatchSearchTreeNode(edge_id, node_to_expand, prediction, original_prediction)
             node_to_expand.children.append(new_child)
             if new_child.is_counterfactual:
@@ -192,7 +209,7 @@ class SearchingCFExplainer(Explainer):
             if len(cf_examples) > 0:
                 best_cf_example = select_best_cf_example(best_cf_example, cf_examples)
                 max_depth = best_cf_example.depth
-                known_cf_examples.extend(np.array(example.to_cf_example().event_ids) for example in cf_examples)
+                known_cf_examples.extend(np.array(example.parent_ids) for example in cf_examples)
                 if self.verbose:
                     self.logger.info(f'Found counterfactual explanation (could be old): '
                                      + str(best_cf_example.to_cf_example()))
@@ -7,6 +7,9 @@ import pandas as pd
 from cody.constants import COL_ID, COL_SUBGRAPH_DISTANCE, COL_TIMESTAMP
 from cody.embedding import Embedding
 
+# Up to this many excluded events, membership is checked with direct comparisons instead of np.isin
+SMALL_EXCLUSION_SIZE = 8
+
 
 def create_embedding_model(emb: Embedding, model_path: str = None, device: str = 'cpu'):
     embedding_model = torch.nn.Sequential(
@@ -22,20 +25,41 @@ def create_embedding_model(emb: Embedding, model_path: str = None, device: str =
     return embedding_model
 
 
-def filter_subgraph(base_event_id: int, excluded_events: np.ndarray, subgraph: pd.DataFrame,
-                    known_cf_examples: List[np.ndarray] | None = None) -> pd.DataFrame:
-    excluded_events = np.concatenate((excluded_events, np.array([base_event_id])))
-    filtered_subgraph = subgraph[~subgraph[COL_ID].isin(excluded_events)]
+def _not_in(values: np.ndarray, excluded_values: np.ndarray) -> np.ndarray:
+    if len(excluded_values) <= SMALL_EXCLUSION_SIZE:
+        mask = np.ones(len(values), dtype=bool)
+        for excluded_value in excluded_values:
+            mask &= (values != excluded_value)
+        return mask
+    return np.isin(values, excluded_values, invert=True)
+
+
+def create_filter_mask(base_event_id: int, excluded_events: np.ndarray, event_ids: np.ndarray,
+                       known_cf_examples: List[np.ndarray] | None = None) -> np.ndarray:
+    """
+    Create a mask over the event ids that filters out the base event, the excluded events and events that would lead to
+    an already known cf example
+    @param base_event_id: ID of the explained event
+    @param excluded_events: Events that are already excluded
+    @param event_ids: Event ids of the subgraph
+    @param known_cf_examples: Already known cf examples
+    @return: Boolean mask that is True for all event ids that remain selectable
+    """
+    mask = (event_ids != base_event_id)
+    mask &= _not_in(event_ids, excluded_events)
     # Make sure that events that would lead to an already known cf example are not sampled as candidates
-    further_events_to_exclude = []
-    if known_cf_examples is not None:
-        for cf_example in known_cf_examples:
-            total_occurrences = np.sum(np.isin(excluded_events, cf_example))
-            if total_occurrences >= len(cf_example) - 1:
-                already_excluded_events = excluded_events[np.isin(excluded_events, cf_example)]
-                event_to_exclude = cf_example[~np.isin(cf_example, already_excluded_events)][0]
-                further_events_to_exclude.append(event_to_exclude)
-    return filtered_subgraph[~filtered_subgraph[COL_ID].isin(further_events_to_exclude)]
+    if known_cf_examples is not None and len(known_cf_examples) > 0:
+        cf_example_events = np.concatenate(known_cf_examples)
+        cf_example_indices = np.repeat(np.arange(len(known_cf_examples)),
+                                       [len(cf_example) for cf_example in known_cf_examples])
+        missing_mask = _not_in(cf_example_events, excluded_events)
+        missing_mask &= (cf_example_events != base_event_id)
+        missing_counts = np.bincount(cf_example_indices[missing_mask], minlength=len(known_cf_examples))
+        # Exclude the only missing event of each cf example that is missing exactly one event
+        further_events_to_exclude = cf_example_events[missing_mask & (missing_counts[cf_example_indices] == 1)]
+        if len(further_events_to_exclude) > 0:
+            mask &= _not_in(event_ids, further_events_to_exclude)
+    return mask
 
 
 class SelectionStrategy:
@@ -43,6 +67,13 @@ class SelectionStrategy:
     def __init__(self, subgraph: pd.DataFrame):
         assert len(subgraph) > 0
         self.subgraph = subgraph
+        self.event_ids = subgraph[COL_ID].to_numpy()
+        # One less than the lowest event id, so that the rollout does not simulate the first event of the subgraph
+        self.min_event_id = int(self.event_ids.min()) - 1
+
+    def _create_filter_mask(self, base_event_id: int, excluded_events: np.ndarray,
+                            known_cf_examples: List[np.ndarray] | None = None) -> np.ndarray:
+        return create_filter_mask(base_event_id, excluded_events, self.event_ids, known_cf_examples)
 
     def sample(self, base_event_id: int, excluded_events: np.ndarray, size: int,
                known_cf_examples: List[np.ndarray] | None = None) -> np.ndarray:
@@ -58,28 +89,65 @@ class SelectionStrategy:
 
 class RandomSelectionStrategy(SelectionStrategy):
 
+    def __init__(self, subgraph: pd.DataFrame):
+        super().__init__(subgraph)
+        self.rng = np.random.default_rng()
+
     def rank_subgraph(self, base_event_id: int, excluded_events: np.ndarray,
                       known_cf_examples: List[np.ndarray] | None = None):
-        filtered_subgraph = filter_subgraph(base_event_id, excluded_events, self.subgraph, known_cf_examples)
-        return filtered_subgraph.sample(frac=1)[COL_ID].to_numpy()
+        mask = self._create_filter_mask(base_event_id, excluded_events, known_cf_examples)
+        return self.rng.permutation(self.event_ids[mask])
+
+    def sample(self, base_event_id: int, excluded_events: np.ndarray, size: int,
+               known_cf_examples: List[np.ndarray] | None = None) -> np.ndarray:
+        mask = self._create_filter_mask(base_event_id, excluded_events, known_cf_examples)
+        filtered_event_ids = self.event_ids[mask]
+        if len(filtered_event_ids) <= size:
+            return self.rng.permutation(filtered_event_ids)
+        return self.rng.choice(filtered_event_ids, size=size, replace=False)
 
 
 class TemporalSelectionStrategy(SelectionStrategy):
 
+    def __init__(self, subgraph: pd.DataFrame):
+        super().__init__(subgraph)
+        self.most_recent_event_ids = self.event_ids[::-1].tolist()
+
     def rank_subgraph(self, base_event_id: int, excluded_events: np.ndarray,
                       known_cf_examples: List[np.ndarray] | None = None):
-        filtered_subgraph = filter_subgraph(base_event_id, excluded_events, self.subgraph, known_cf_examples)
-        return filtered_subgraph[COL_ID].to_numpy()[::-1]
+        mask = self._create_filter_mask(base_event_id, excluded_events, known_cf_examples)
+        return self.event_ids[mask][::-1]
+
+    def sample(self, base_event_id: int, excluded_events: np.ndarray, size: int,
+               known_cf_examples: List[np.ndarray] | None = None) -> np.ndarray:
+        if known_cf_examples:
+            return super().sample(base_event_id, excluded_events, size, known_cf_examples)
+        # Only the most recent events are needed -> scan from the end instead of filtering the whole subgraph
+        excluded = set(excluded_events.tolist())
+        excluded.add(base_event_id)
+        sampled_event_ids = []
+        for event_id in self.most_recent_event_ids:
+            if len(sampled_event_ids) >= size:
+                break
+            if event_id not in excluded:
+                sampled_event_ids.append(event_id)
+        return np.array(sampled_event_ids, dtype=self.event_ids.dtype)
 
 
 class SpatioTemporalSelectionStrategy(SelectionStrategy):
 
+    def __init__(self, subgraph: pd.DataFrame):
+        super().__init__(subgraph)
+        self.subgraph_distances = subgraph[COL_SUBGRAPH_DISTANCE].to_numpy()
+        self.timestamps = subgraph[COL_TIMESTAMP].to_numpy()
+        # Closest events first, most recent events first among events with the same distance. The ordering is fixed,
+        #  so it is computed once and only filtered per ranking
+        self.order = np.lexsort((-self.timestamps, self.subgraph_distances))
+
     def rank_subgraph(self, base_event_id: int, excluded_events: np.ndarray,
                       known_cf_examples: List[np.ndarray] | None = None):
-        filtered_subgraph = filter_subgraph(base_event_id, excluded_events, self.subgraph, known_cf_examples)
-        sorted_subgraph = filtered_subgraph.sort_values(by=[COL_SUBGRAPH_DISTANCE, COL_TIMESTAMP],
-                                                        ascending=[True, False])
-        return sorted_subgraph[COL_ID].to_numpy()
+        mask = self._create_filter_mask(base_event_id, excluded_events, known_cf_examples)
+        return self.event_ids[self.order[mask[self.order]]]
 
 
 @dataclass
@@ -98,44 +166,48 @@ class PretrainedSelectionStrategy(SelectionStrategy):
         self.embedding = parameters.embedding
         self.positive_original_prediction = (original_prediction > 0)
         self.initial_weights = None
+        self.initial_order = None
         self.embedding_model.eval()
         if not parameters.predict_for_each_sample:
-            subgraph_ids = self.subgraph[COL_ID].to_numpy()
-            weights = self._embeddings_to_weights(subgraph_ids, explained_event_id)
-            self.initial_weights = weights.detach().cpu().flatten().numpy()
+            self.initial_weights = self._embeddings_to_weights(self.event_ids, explained_event_id)
+            # The weights are fixed, so the ranking of the full subgraph only has to be computed once
+            if self.positive_original_prediction:
+                self.initial_order = np.argsort(self.initial_weights, kind='stable')
+            else:
+                self.initial_order = np.argsort(-self.initial_weights, kind='stable')
 
     def _embeddings_to_weights(self, event_ids, base_event_id):
-        excluded_edges_embeddings, explained_edge_embedding = self.embedding.get_embeddings(event_ids, base_event_id)
-        explained_edge_embeddings = torch.tile(explained_edge_embedding, (len(excluded_edges_embeddings), 1))
-        predictions = torch.nn.functional.cosine_similarity(explained_edge_embeddings, excluded_edges_embeddings)
-        return predictions.detach().cpu().flatten().numpy()
+        with torch.no_grad():
+            excluded_edges_embeddings, explained_edge_embedding = self.embedding.get_embeddings(event_ids,
+                                                                                                base_event_id)
+            # The explained edge embedding is broadcast against all excluded edge embeddings
+            predictions = torch.nn.functional.cosine_similarity(explained_edge_embedding.unsqueeze(0),
+                                                                excluded_edges_embeddings)
+        return predictions.cpu().flatten().numpy()
 
     def rank_subgraph(self, base_event_id: int, excluded_events: np.ndarray,
                       known_cf_examples: List[np.ndarray] | None = None):
-        filtered_subgraph = filter_subgraph(base_event_id, excluded_events, self.subgraph, known_cf_examples)
-        event_ids = filtered_subgraph[COL_ID].to_numpy()
-        if self.initial_weights is None:
-            weights = self._embeddings_to_weights(event_ids, base_event_id)
-        else:
-            subgraph_without_base_event = self.subgraph[self.subgraph[COL_ID] != base_event_id]
-            edge_mask = subgraph_without_base_event[COL_ID].isin(event_ids).to_numpy()
-            weights = self.initial_weights[edge_mask]
-        filtered_subgraph['weight'] = weights
-        sorted_subgraph = filtered_subgraph.sort_values(by='weight', ascending=self.positive_original_prediction)
-        return sorted_subgraph[COL_ID].to_numpy()
+        mask = self._create_filter_mask(base_event_id, excluded_events, known_cf_examples)
+        if self.initial_order is not None:
+            return self.event_ids[self.initial_order[mask[self.initial_order]]]
+        event_ids = self.event_ids[mask]
+        weights = self._embeddings_to_weights(event_ids, base_event_id)
+        if not self.positive_original_prediction:
+            weights = -weights
+        return event_ids[np.argsort(weights, kind='stable')]
 
 
 class LocalGradientSelectionStrategy(SelectionStrategy):
 
     def __init__(self, subgraph: pd.DataFrame):
         super().__init__(subgraph)
-        self.subgraph['weight'] = 0
+        self.weights = np.zeros(len(self.event_ids), dtype=np.float64)
+        self.event_positions = {event_id: position for position, event_id in enumerate(self.event_ids.tolist())}
 
     def set_event_weight(self, event_id: int, weight: float):
-        self.subgraph.loc[self.subgraph[COL_ID] == event_id, 'weight'] = weight
+        self.weights[self.event_positions[int(event_id)]] = weight
 
     def rank_subgraph(self, base_event_id: int, excluded_events: np.ndarray,
                       known_cf_examples: List[np.ndarray] | None = None):
-        filtered_subgraph = filter_subgraph(base_event_id, excluded_events, self.subgraph, known_cf_examples)
-        sorted_subgraph = filtered_subgraph.sort_values(by='weight', ascending=False)
-        return sorted_subgraph[COL_ID].to_numpy()
+        mask = self._create_filter_mask(base_event_id, excluded_events, known_cf_examples)
+        return self.event_ids[mask][np.argsort(-self.weights[mask], kind='stable')]
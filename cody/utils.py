@@ -24,10 +24,14 @@ def _is_running_in_notebook() -> bool:
         return False
 
 
+# The environment does not change while the module is loaded, so it is only probed once
+RUNNING_IN_NOTEBOOK = _is_running_in_notebook()
+
+
 class ProgressBar:
 
     def __init__(self, max_item: int, prefix: str = ''):
-        self.running_in_notebook = _is_running_in_notebook()
+        self.running_in_notebook = RUNNING_IN_NOTEBOOK
         if self.running_in_notebook:
             self.progress_bar = tqdm_notebook(total=max_item, desc=prefix)
         else:
@@ -42,8 +46,9 @@ class ProgressBar:
 
     def next(self):
         self.current_value += 1
+        # tqdm only redraws once its minimum update interval has passed, so fast loops do not pay for terminal output
+        #  on every step. The final state is drawn when the progress bar is closed
         self.progress_bar.update(1)
-        self.progress_bar.refresh()
 
     def reset(self, total: int = 100):
         self.current_value = 0
@@ -53,6 +58,8 @@ class ProgressBar:
         self.progress_bar.close()
 
     def update_postfix(self, postfix: str):
+        if self.progress_bar.postfix == postfix:
+            return  # Nothing changed -> avoid redrawing the progress bar
         self.progress_bar.postfix = postfix
         self.progress_bar.update(0)
 
@@ -1,4 +1,5 @@
 import glob
+import itertools
 import logging
 import os
 import sys
@@ -45,14 +46,33 @@ def add_model_training_arguments(parser: ArgumentParser):
     parser.add_argument('-e', '--epochs', type=int, default=50, help='Number of epochs to train the model for.')
 
 
+def _column_to_array(df, column_name, dtype):
+    if len(df) == 0:
+        return  # np.split would produce one empty array, which cannot be assigned to an empty frame
+    tokens = df[column_name].str.rstrip(']').str.lstrip('[').str.split()
+    lengths = tokens.str.len().to_numpy()
+    # Parse the values of all rows at once and split them back into one array per row
+    values = np.array(list(itertools.chain.from_iterable(tokens)), dtype=str).astype(dtype)
+    df[column_name] = np.split(values, np.cumsum(lengths)[:-1])
+
+
 def column_to_int_array(df, column_name):
-    df[column_name] = (df[column_name].str.rstrip(']').str.lstrip('[')
-                       .replace('\n', '').str.split().apply(lambda x: np.array([int(item) for item in x])))
+    _column_to_array(df, column_name, np.int64)
 
 
 def column_to_float_array(df, column_name):
-    df[column_name] = (df[column_name].str.rstrip(']').str.lstrip('[')
-                       .replace('\n', '').str.split().apply(lambda x: np.array([float(item) for item in x])))
+    _column_to_array(df, column_name, np.float64)
+
+
+def get_explained_event_ids_from_results(results_filepath: str) -> np.ndarray:
+    parquet_file_path = results_filepath.rstrip('csv') + 'parquet'
+    if os.path.exists(parquet_file_path):
+        try:
+            # Only the column with the explained event ids is read from the parquet file
+            return pd.read_parquet(parquet_file_path, columns=['explained_event_id'])['explained_event_id'].to_numpy()
+        except ImportError:
+            pass
+    return pd.read_csv(results_filepath, usecols=['explained_event_id'])['explained_event_id'].to_numpy()
 
 
 def create_dataset_from_args(args: Namespace, parameters: TrainTestDatasetParameters | None = None) -> (
@@ -116,7 +136,8 @@ def create_tgn_wrapper_from_args(args: Namespace, dataset: ContinuousTimeDynamic
 def get_event_ids_from_file(event_ids_filepath: str | None, logger: logging.Logger,
                             wrong_predictions_only: bool = False, tgn_wrapper: TGNWrapper | TTGNWrapper = None):
     if os.path.exists(event_ids_filepath):
-        return np.load(event_ids_filepath)
+        # The ids are only read, so they are memory-mapped instead of loaded into memory as a whole
+        return np.load(event_ids_filepath, mmap_mode='r')
     else:
         logger.info('No event ids to explain provided. Generating new ones...')
         assert tgn_wrapper is not None, 'Cannot sample predictions if model is not provided'
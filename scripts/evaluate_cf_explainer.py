@@ -6,14 +6,16 @@ from typing import List
 
 import numpy as np
 import pandas as pd
+import torch
 
+from cody.cache import PredictionCache, checkpoint_identifier
 from cody.constants import COL_ID, EXPLAINED_EVENT_MEMORY_LABEL
 from cody.data import TrainTestDatasetParameters
 from cody.embedding import DynamicEmbedding, StaticEmbedding
 from cody.selection import create_embedding_model, PretrainedSelectionStrategyParameters
 from common import (add_dataset_arguments, add_wrapper_model_arguments, create_dataset_from_args,
                     create_tgn_wrapper_from_args, parse_args, get_event_ids_from_file, SAMPLERS, column_to_int_array,
-                    column_to_float_array)
+                    column_to_float_array, get_explained_event_ids_from_results)
 
 from scripts.evaluation_explainers import EvaluationExplainer, EvaluationCounterFactualExample, \
     EvaluationGreedyCFExplainer, EvaluationSearchingCFExplainer, EvaluationCoDy
@@ -24,19 +26,24 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
 
+@torch.no_grad()  # The evaluation only runs inference, so no autograd graphs have to be recorded
 def evaluate(evaluated_explainers: List[EvaluationExplainer], explained_event_ids: np.ndarray, optimize: bool = False,
              max_time_seconds: int = 72 * 60):
     assert len(evaluated_explainers) > 0
+    # Explaining the events in temporal order lets consecutive explanations continue from earlier memory rollouts
+    explained_event_ids = np.sort(explained_event_ids)
     progress_bar = ProgressBar(len(explained_event_ids), prefix='Evaluating explainer')
     start_time = time.time()
-    base_explainer = explainers[0]
+    # Explanations that are still running when the time limit is reached conclude their search early and are discarded
+    deadline = start_time + max_time_seconds
+    base_explainer = evaluated_explainers[0]
     tgnn = base_explainer.tgnn
     tgnn.set_evaluation_mode(True)
     memory_backups = {}
 
     if optimize:
         rollout_event_ids = {}
-        for event_id in explained_event_ids:
+        for event_id in explained_event_ids.tolist():
             subgraph = base_explainer.subgraph_generator.get_fixed_size_k_hop_temporal_subgraph(base_explainer.num_hops,
                                                                                                 event_id,
                                                                                                 base_explainer.
@@ -54,31 +61,40 @@ def evaluate(evaluated_explainers: List[EvaluationExplainer], explained_event_id
                 memory_backups[event_id] = (rollout_event_id, memory_backup)
             tgnn.restore_memory(last_batch_end_memory, last_batch_end_id)
 
-    for event_id in explained_event_ids:
-        progress_bar.update_postfix(f'Generating original score for event {event_id}')
+    for event_id in explained_event_ids.tolist():
         if time.time() - start_time > max_time_seconds:
             logger.info("Time limit reached. Finishing evaluation...")
             break
+        # Every explainer resets the model at the end of its explanation and restoring a memory backup resets the
+        #  model as well, so the model only has to be reset after rolling out the events for the original prediction
         if optimize:
-            tgnn.reset_model()
+            progress_bar.update_postfix(f'Generating original score for event {event_id}')
             restore_event_id, memory_backup = memory_backups[event_id]
             # tgnn.restore_memory(memory_backup, restore_event_id)
             tgnn.memory_backups_map[EXPLAINED_EVENT_MEMORY_LABEL] = (memory_backup, restore_event_id)
             original_prediction = base_explainer.calculate_original_score(event_id, restore_event_id)
+            tgnn.reset_model()
         else:
             original_prediction = None
-        tgnn.reset_model()
         progress_bar.update_postfix(f'Generating explanation for event {event_id}')
+        explanations = []
         for selected_explainer in evaluated_explainers:
-            explanation = selected_explainer.evaluate_explanation(event_id, original_prediction)
-            selected_explainer.explanation_results_list.append(explanation)
+            explanation = selected_explainer.evaluate_explanation(event_id, original_prediction, deadline=deadline)
+            explanations.append(explanation)
             # Set the original prediction in the first iteration so that it does not have to be calculated again
             original_prediction = explanation.original_prediction
             if optimize:
                 restore_event_id, memory_backup = memory_backups[event_id]
                 tgnn.memory_backups_map[EXPLAINED_EVENT_MEMORY_LABEL] = (memory_backup, restore_event_id)
-                tgnn.reset_model()
-        scripts.evaluation_explainers.EVALUATION_STATE_CACHE = {}  # Reset the state cache
+        # The cached predictions are keyed by the explained event, so they cannot be reused for other events
+        scripts.evaluation_explainers.EVALUATION_STATE_CACHE.clear()
+        if any(explanation.statistics.get('deadline_reached', False) for explanation in explanations):
+            # Truncated searches are not stored, so that a resumed evaluation explains the event again
+            logger.info(f'Time limit reached while explaining event {event_id}. Discarding its results and finishing '
+                        f'evaluation...')
+            break
+        for selected_explainer, explanation in zip(evaluated_explainers, explanations):
+            selected_explainer.explanation_results_list.append(explanation)
         progress_bar.next()
     progress_bar.close()
 
@@ -154,6 +170,13 @@ if __name__ == '__main__':
                         help='Maximum number of search steps to perform.')
     parser.add_argument('--no_approximation', action='store_true',
                         help='Provide if approximation should be disabled')
+    parser.add_argument('--early_stop', action='store_true',
+                        help='CoDy only: Provide to stop the search once a counterfactual example consisting of a '
+                             'single event is found')
+    parser.add_argument('--prediction_cache', type=str, default=None,
+                        help='Path to a sqlite file in which subgraph predictions are cached across runs. Cached '
+                             'predictions skip the TGNN forward pass, so their measured oracle call times are lower. '
+                             'Disabled by default.')
 
     args = parse_args(parser)
 
@@ -165,6 +188,11 @@ if __name__ == '__main__':
     event_ids_to_explain = get_event_ids_from_file(args.explained_ids, logger, args.wrong_predictions_only,
                                                    tgn_wrapper)
 
+    prediction_cache = None
+    if args.prediction_cache is not None:
+        # Predictions are only reused for the same model weights
+        prediction_cache = PredictionCache(args.prediction_cache, model_identifier=checkpoint_identifier(args.model))
+
     sampler_params = None
 
     if args.sampler == 'pretrained':
@@ -174,6 +202,9 @@ if __name__ == '__main__':
             embedding = StaticEmbedding(dataset, tgn_wrapper)
 
         pretrained_sampler_model = create_embedding_model(embedding, args.sampler_model_path, tgn_wrapper.device)
+        # The sampler model is only used for inference during the evaluation
+        pretrained_sampler_model.requires_grad_(False)
+        pretrained_sampler_model.eval()
         sampler_params = PretrainedSelectionStrategyParameters(pretrained_sampler_model, embedding,
                                                                predict_for_each_sample=args.predict_for_each_sample)
     explainers = []
@@ -186,14 +217,16 @@ if __name__ == '__main__':
                                                                   sample_size=args.sample_size,
                                                                   pretrained_sampler_parameters=sampler_params,
                                                                   verbose=args.debug,
-                                                                  approximate_predictions=not args.no_approximation))
+                                                                  approximate_predictions=not args.no_approximation,
+                                                                  prediction_cache=prediction_cache))
             else:
                 explainers.append(EvaluationGreedyCFExplainer(tgn_wrapper, selection_strategy=args.sampler,
                                                               candidates_size=args.candidates_size,
                                                               sample_size=args.sample_size,
                                                               pretrained_sampler_parameters=sampler_params,
                                                               verbose=args.debug,
-                                                              approximate_predictions=not args.no_approximation))
+                                                              approximate_predictions=not args.no_approximation,
+                                                              prediction_cache=prediction_cache))
         case 'searching':
             if args.sampler == 'all':
                 for sampler in SAMPLERS:
@@ -202,14 +235,16 @@ if __name__ == '__main__':
                                                        candidates_size=args.candidates_size,
                                                        sample_size=args.sample_size, verbose=args.debug,
                                                        pretrained_sampler_parameters=sampler_params,
-                                                       approximate_predictions=not args.no_approximation))
+                                                       approximate_predictions=not args.no_approximation,
+                                                       prediction_cache=prediction_cache))
             else:
                 explainers.append(EvaluationSearchingCFExplainer(tgn_wrapper, selection_strategy=args.sampler,
                                                                  max_steps=args.max_steps,
                                                                  candidates_size=args.candidates_size,
                                                                  sample_size=args.sample_size, verbose=args.debug,
                                                                  pretrained_sampler_parameters=sampler_params,
-                                                                 approximate_predictions=not args.no_approximation))
+                                                                 approximate_predictions=not args.no_approximation,
+                                                                 prediction_cache=prediction_cache))
         case 'cody':
             if args.sampler == 'all':
                 for sampler in SAMPLERS:
@@ -217,26 +252,32 @@ if __name__ == '__main__':
                                                      candidates_size=args.candidates_size,
                                                      max_steps=args.max_steps, verbose=args.debug,
                                                      pretrained_sampler_parameters=sampler_params,
-                                                     approximate_predictions=not args.no_approximation))
+                                                     approximate_predictions=not args.no_approximation,
+                                                     early_stop=args.early_stop,
+                                                     prediction_cache=prediction_cache))
             else:
                 explainers.append(EvaluationCoDy(tgn_wrapper, selection_strategy=args.sampler,
                                                  candidates_size=args.candidates_size,
                                                  max_steps=args.max_steps, verbose=args.debug,
                                                  pretrained_sampler_parameters=sampler_params,
-                                                 approximate_predictions=not args.no_approximation))
+                                                 approximate_predictions=not args.no_approximation,
+                                                 early_stop=args.early_stop,
+                                                 prediction_cache=prediction_cache))
         case _:
             raise NotImplementedError
 
     if os.path.exists(construct_results_save_path(args, explainers[0])):
-        previous_results = pd.read_csv(construct_results_save_path(args, explainers[0]))
-        encountered_event_ids = previous_results['explained_event_id'].to_numpy()
+        encountered_event_ids = get_explained_event_ids_from_results(construct_results_save_path(args, explainers[0]))
         logger.info(f'Resuming evaluation. '
                     f'Already processed {len(encountered_event_ids)}/{len(event_ids_to_explain)} events.')
-        event_ids_to_explain = event_ids_to_explain[~np.isin(event_ids_to_explain, encountered_event_ids)]
+        event_ids_to_explain = np.setdiff1d(event_ids_to_explain, encountered_event_ids)
     try:
         evaluate(explainers, event_ids_to_explain, args.optimize, args.max_time * 60)
     except KeyboardInterrupt:
         logger.info('Evaluation interrupted. Saving current results...')
+    finally:
+        if prediction_cache is not None:
+            prediction_cache.close()  # Commits the predictions that are still pending
     for explainer in explainers:
         if len(explainer.explanation_results_list) > 0:
             export_explanations(explainer.explanation_results_list, construct_results_save_path(args, explainer))
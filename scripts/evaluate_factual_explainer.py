@@ -17,7 +17,7 @@ from TTGN.model.tgn import TGN
 from TTGN.utils.utils import get_neighbor_finder
 
 from common import add_dataset_arguments, add_wrapper_model_arguments, create_dataset_from_args, parse_args, \
-    get_event_ids_from_file, column_to_int_array, column_to_float_array
+    get_event_ids_from_file, column_to_int_array, column_to_float_array, get_explained_event_ids_from_results
 
 from cody.implementations.ttgn import TTGNWrapper
 from cody.explainer.baseline.pgexplainer import TPGExplainer, FactualExplanation
@@ -26,7 +26,10 @@ from cody.explainer.baseline.tgnnexplainer import TGNNExplainer, TGNNExplainerEx
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
+EMPTY_CACHE_INTERVAL = 50  # Number of explained events after which unused cached GPU memory is released
 
+
+@torch.no_grad()  # The evaluation only runs inference, so no autograd graphs have to be recorded
 def evaluate(evaluated_explainer: TGNNExplainer | TPGExplainer, explained_event_ids: np.ndarray,
              max_time_seconds: int = 72 * 60):
     explanation_list = []
@@ -34,7 +37,10 @@ def evaluate(evaluated_explainer: TGNNExplainer | TPGExplainer, explained_event_
     progress_bar = ProgressBar(len(explained_event_ids), prefix='Evaluating explainer')
     start_time = time.time()
 
-    for event_id in explained_event_ids:
+    for index, event_id in enumerate(explained_event_ids.tolist()):
+        if index > 0 and index % EMPTY_CACHE_INTERVAL == 0 and torch.cuda.is_available():
+            # Return cached blocks sized for earlier, larger candidate subgraphs to the device
+            torch.cuda.empty_cache()
         if time.time() - start_time > max_time_seconds:
             logger.info("Time limit reached. Finishing evaluation...")
             break
@@ -157,11 +163,11 @@ if __name__ == '__main__':
             raise NotImplementedError
 
     if os.path.exists(args.results):
-        previous_results = pd.read_csv(args.results)
-        encountered_event_ids = previous_results['explained_event_id'].to_numpy()
+        encountered_event_ids = get_explained_event_ids_from_results(args.results)
         logger.info(f'Resuming evaluation. '
                     f'Already processed {len(encountered_event_ids)}/{len(event_ids_to_explain)} events.')
-        event_ids_to_explain = event_ids_to_explain[~np.isin(event_ids_to_explain, encountered_event_ids)]
+        # Keeps the order of the remaining events, np.setdiff1d would sort them
+        event_ids_to_explain = event_ids_to_explain[np.isin(event_ids_to_explain, encountered_event_ids, invert=True)]
 
     explanations = evaluate(explainer, event_ids_to_explain, args.max_time * 60)
     export_explanations(explanations, args.results)
@@ -5,8 +5,9 @@ from typing import Dict, List
 import numpy as np
 import time
 
+from cody.cache import PredictionCache
 from cody.implementations.connector import TGNNWrapper
-from cody.constants import CUR_IT_MIN_EVENT_MEM_LBL, EXPLAINED_EVENT_MEMORY_LABEL, COL_ID
+from cody.constants import CUR_IT_MIN_EVENT_MEM_LBL, EXPLAINED_EVENT_MEMORY_LABEL
 from cody.explainer.base import Explainer, CounterFactualExample, TreeNode
 from cody.explainer.greedy import GreedyCFExplainer, GreedyTreeNode
 from cody.selection import SelectionStrategy, PretrainedSelectionStrategyParameters, LocalGradientSelectionStrategy
@@ -50,9 +51,10 @@ class EvaluationExplainer(Explainer):
 
     def __init__(self, tgnn_wrapper: TGNNWrapper, selection_strategy: str = 'recent', candidates_size: int = 75,
                  sample_size: int = 10, verbose: bool = False, approximate_predictions: bool = True,
-                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None):
+                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None,
+                 prediction_cache: PredictionCache | None = None):
         super().__init__(tgnn_wrapper, selection_strategy, candidates_size, sample_size, verbose,
-                         approximate_predictions, pretrained_sampler_parameters)
+                         approximate_predictions, pretrained_sampler_parameters, prediction_cache)
         self.explanation_results_list = []
 
     def initialize_explanation_evaluation(self, explained_event_id: int, original_prediction: float) -> SelectionStrategy:
@@ -62,12 +64,15 @@ class EvaluationExplainer(Explainer):
         self.tgnn.set_evaluation_mode(True)
         return self._create_sampler(subgraph, explained_event_id, original_prediction=original_prediction)
 
-    def evaluate_explanation(self, explained_event_id: int, original_prediction: float) -> (
-            EvaluationCounterFactualExample):
+    def evaluate_explanation(self, explained_event_id: int, original_prediction: float,
+                             deadline: float | None = None) -> EvaluationCounterFactualExample:
         """
         Explain the provided event
         @param explained_event_id: Event id to explain
         @param original_prediction: Original prediction for the event
+        @param deadline: Point in time (as returned by time.time()) after which the search is concluded with the best
+        explanation found so far. The statistics of such a truncated explanation contain 'deadline_reached'. If None,
+        the search is not limited in time
         @return: The counterfactual explanation
         """
         raise NotImplementedError
@@ -77,15 +82,18 @@ class EvaluationGreedyCFExplainer(GreedyCFExplainer, EvaluationExplainer):
 
     def __init__(self, tgnn_wrapper: TGNNWrapper, selection_strategy: str = 'recent', sample_size: int = 10,
                  candidates_size: int = 64, verbose: bool = False, approximate_predictions: bool = True,
-                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None):
+                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None,
+                 prediction_cache: PredictionCache | None = None):
         super(GreedyCFExplainer, self).__init__(tgnn_wrapper=tgnn_wrapper, selection_strategy=selection_strategy,
                                                 sample_size=sample_size, candidates_size=candidates_size,
                                                 verbose=verbose, approximate_predictions=approximate_predictions,
-                                                pretrained_sampler_parameters=pretrained_sampler_parameters)
+                                                pretrained_sampler_parameters=pretrained_sampler_parameters,
+                                                prediction_cache=prediction_cache)
         super(EvaluationExplainer, self).__init__(tgnn_wrapper=tgnn_wrapper, selection_strategy=selection_strategy,
                                                   candidates_size=candidates_size, sample_size=sample_size,
                                                   verbose=verbose, approximate_predictions=approximate_predictions,
-                                                  pretrained_sampler_parameters=pretrained_sampler_parameters)
+                                                  pretrained_sampler_parameters=pretrained_sampler_parameters,
+                                                  prediction_cache=prediction_cache)
         self.last_min_id = 0
 
     def create_child_node(self, node_to_expand: TreeNode, memory_label: str, explained_event_id: int,
@@ -113,8 +121,8 @@ class EvaluationGreedyCFExplainer(GreedyCFExplainer, EvaluationExplainer):
         node_to_expand.children.append(child_node)
         return child_node, oracle_call_duration, exp_cache_save_time
 
-    def evaluate_explanation(self, explained_event_id: int,
-                             original_prediction: float) -> EvaluationCounterFactualExample:
+    def evaluate_explanation(self, explained_event_id: int, original_prediction: float,
+                             deadline: float | None = None) -> EvaluationCounterFactualExample:
         if original_prediction is None:
             original_prediction, sampler = self.initialize_explanation(explained_event_id)
         else:
@@ -125,7 +133,7 @@ class EvaluationGreedyCFExplainer(GreedyCFExplainer, EvaluationExplainer):
         oracle_call_time = 0
         cache_saved_oracle_call_time = 0
         start_time = time.time_ns()
-        min_event_id = sampler.subgraph[COL_ID].min() - 1
+        min_event_id = sampler.min_event_id
         root_node = GreedyTreeNode(explained_event_id, None, original_prediction=original_prediction,
                                    prediction=original_prediction)
         max_depth = sys.maxsize
@@ -139,8 +147,7 @@ class EvaluationGreedyCFExplainer(GreedyCFExplainer, EvaluationExplainer):
                                                                              memory_label=EXPLAINED_EVENT_MEMORY_LABEL,
                                                                              explained_event_id=explained_event_id,
                                                                              candidate_event_id=child_id,
-                                                                             sampled_edge_ids=
-                                                                             sampler.subgraph[COL_ID].to_numpy())
+                                                                             sampled_edge_ids=sampler.event_ids)
                 oracle_call_time += oc_duration
                 cache_saved_oracle_call_time += saved_time
                 oracle_calls += 1
@@ -154,12 +161,15 @@ class EvaluationGreedyCFExplainer(GreedyCFExplainer, EvaluationExplainer):
                 sampler.set_event_weight(child_node.edge_id, child_node.exploitation_score)
             if best_cf_example is not None:
                 skip_search = True
-            root_node.expanded = True
+            root_node.mark_expanded()
 
         i = 0
         init_end_time = time.time_ns()
         timings['init_duration'] = init_end_time - start_time
         while not skip_search:
+            if deadline is not None and time.time() > deadline:
+                statistics['deadline_reached'] = True
+                break
             node_to_expand = root_node.select_next_leaf(max_depth)
             if node_to_expand is None or (node_to_expand == root_node and root_node.expanded):
                 break  # No more nodes can be selected -> conclude search without a cf-example
@@ -183,14 +193,12 @@ class EvaluationGreedyCFExplainer(GreedyCFExplainer, EvaluationExplainer):
                 oracle_calls += 1
                 cache_saved_oracle_call_time += exp_cache_save_time
                 if child_node.is_counterfactual:
-                    if best_cf_example is None:
-                        best_cf_example = child_node
-                    elif best_cf_example.exploitation_score < child_node.exploitation_score:
-                        best_cf_example = child_node
+                    best_cf_example = child_node
                     if self.verbose:
                         self.logger.info(f'Found counterfactual explanation: ' + str(child_node.to_cf_example()))
+                    break  # Counterfactual found -> scoring the remaining candidates would only waste oracle calls
             self.tgnn.remove_memory_backup(CUR_IT_MIN_EVENT_MEM_LBL)
-            node_to_expand.expanded = True
+            node_to_expand.mark_expanded()
             if best_cf_example is not None:
                 break
             i += 1
@@ -206,7 +214,7 @@ class EvaluationGreedyCFExplainer(GreedyCFExplainer, EvaluationExplainer):
         timings['total_duration'] = end_time - start_time + cache_saved_oracle_call_time
         statistics['oracle_calls'] = oracle_calls
         statistics['candidate_size'] = len(sampler.subgraph)
-        statistics['candidates'] = sampler.subgraph[COL_ID].to_numpy()
+        statistics['candidates'] = sampler.event_ids
         result_cf_example = best_example.to_cf_example()
         cf_example = EvaluationCounterFactualExample(explained_event_id=explained_event_id,
                                                      original_prediction=original_prediction,
@@ -228,15 +236,18 @@ class EvaluationSearchingCFExplainer(SearchingCFExplainer, EvaluationExplainer):
     def __init__(self, tgnn_wrapper: TGNNWrapper, selection_strategy: str = 'recent', max_steps: int = 100,
                  sample_size: int = 10, candidates_size: int = 64, verbose: bool = False,
                  approximate_predictions: bool = True,
-                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None):
+                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None,
+                 prediction_cache: PredictionCache | None = None):
         SearchingCFExplainer.__init__(self, tgnn_wrapper=tgnn_wrapper, selection_strategy=selection_strategy,
                                       sample_size=sample_size, candidates_size=candidates_size, verbose=verbose,
                                       approximate_predictions=approximate_predictions,
-                                      max_steps=max_steps, pretrained_sampler_parameters=pretrained_sampler_parameters)
+                                      max_steps=max_steps, pretrained_sampler_parameters=pretrained_sampler_parameters,
+                                      prediction_cache=prediction_cache)
         EvaluationExplainer.__init__(self, tgnn_wrapper=tgnn_wrapper, selection_strategy=selection_strategy,
                                      candidates_size=candidates_size, sample_size=sample_size, verbose=verbose,
                                      approximate_predictions=approximate_predictions,
-                                     pretrained_sampler_parameters=pretrained_sampler_parameters)
+                                     pretrained_sampler_parameters=pretrained_sampler_parameters,
+                                     prediction_cache=prediction_cache)
         self.last_min_id = 0
 
     def expand_node(self, explained_edge_id: int, node_to_expand: BatchSearchTreeNode, sampler: SelectionStrategy,
@@ -255,19 +266,19 @@ class EvaluationSearchingCFExplainer(SearchingCFExplainer, EvaluationExplainer):
             self.logger.info(f'Selected node {str(node_to_expand.edge_id)} and excluded edge ids '
                              f'{str(edge_ids_to_exclude)}')
         if len(sampled_edge_ids) > 0:
-            min_event_id = sampler.subgraph[COL_ID].min() - 1
+            min_event_id = sampler.min_event_id
             self.tgnn.initialize(min_event_id, show_progress=False,
                                  memory_label=EXPLAINED_EVENT_MEMORY_LABEL)
-        for edge_id in sampled_edge_ids:
-            oracle_call_start = time.time_ns()
-            prediction = self.calculate_subgraph_prediction(candidate_events=sampled_edge_ids,
-                                                            cf_example_events=edge_ids_to_exclude,
-                                                            explained_event_id=explained_edge_id,
-                                                            candidate_event_id=edge_id,
-                                                            original_prediction=original_prediction,
-                                                            memory_label=CUR_IT_MIN_EVENT_MEM_LBL)
-            oracle_call_time += time.time_ns() - oracle_call_start
-            oracle_calls += 1
+        oracle_call_start = time.time_ns()
+        predictions = self.calculate_subgraph_predictions(candidate_events=sampled_edge_ids,
+                                                         cf_example_events=edge_ids_to_exclude,
+                                                         explained_event_id=explained_edge_id,
+                                                         candidate_event_ids=sampled_edge_ids,
+                                                         original_prediction=original_prediction,
+                                                         memory_label=CUR_IT_MIN_EVENT_MEM_LBL)
+        oracle_call_time += time.time_ns() - oracle_call_start
+        oracle_calls += len(predictions)
+        for edge_id, prediction in zip(sampled_edge_ids, predictions.tolist()):
             new_child = BatchSearchTreeNode(edge_id, node_to_expand, prediction, original_prediction)
             node_to_expand.children.append(new_child)
             if new_child.is_counterfactual:
@@ -275,8 +286,8 @@ class EvaluationSearchingCFExplainer(SearchingCFExplainer, EvaluationExplainer):
         self.tgnn.remove_memory_backup(CUR_IT_MIN_EVENT_MEM_LBL)
         return counterfactual_examples, oracle_calls, oracle_call_time
 
-    def evaluate_explanation(self, explained_event_id: int, original_prediction: float) -> (
-            EvaluationCounterFactualExample):
+    def evaluate_explanation(self, explained_event_id: int, original_prediction: float,
+                             deadline: float | None = None) -> EvaluationCounterFactualExample:
         if original_prediction is None:
             original_prediction, sampler = self.initialize_explanation(explained_event_id)
         else:
@@ -284,7 +295,7 @@ class EvaluationSearchingCFExplainer(SearchingCFExplainer, EvaluationExplainer):
         timings = {}
         statistics = {}
         start_time = time.time_ns()
-        min_event_id = sampler.subgraph[COL_ID].min() - 1
+        min_event_id = sampler.min_event_id
         if 0 < self.last_min_id <= min_event_id:
             self.tgnn.initialize(self.last_min_id, show_progress=False,
                                  memory_label=EXPLAINED_EVENT_MEMORY_LABEL)
@@ -301,6 +312,9 @@ class EvaluationSearchingCFExplainer(SearchingCFExplainer, EvaluationExplainer):
         init_end_time = time.time_ns()
         timings['init_duration'] = init_end_time - start_time
         while step <= self.max_steps:
+            if deadline is not None and time.time() > deadline:
+                statistics['deadline_reached'] = True
+                break
             step += 1
             node_to_expand = root_node.select_next_leaf(max_depth)
             node_to_expand.selection_backpropagation()
@@ -316,14 +330,14 @@ class EvaluationSearchingCFExplainer(SearchingCFExplainer, EvaluationExplainer):
             if len(cf_examples) > 0:
                 best_cf_example = select_best_cf_example(best_cf_example, cf_examples)
                 max_depth = best_cf_example.depth
-                known_cf_examples.extend(np.array(example.to_cf_example().event_ids) for example in cf_examples)
+                known_cf_examples.extend(np.array(example.parent_ids) for example in cf_examples)
                 if self.verbose:
                     self.logger.info(f'Found counterfactual explanation (could be old): '
                                      + str(best_cf_example.to_cf_example()))
         if best_cf_example is None:
             best_cf_example = find_best_non_counterfactual_example(root_node)
         # self.tgnn_bridge.remove_memory_backup(EXPLAINED_EVENT_MEMORY_LABEL)
-        self.last_min_id = sampler.subgraph[COL_ID].min() - 1
+        self.last_min_id = sampler.min_event_id
         self.tgnn.reset_model()
         end_time = time.time_ns()
         timings['oracle_call_duration'] = oracle_call_time
@@ -331,7 +345,7 @@ class EvaluationSearchingCFExplainer(SearchingCFExplainer, EvaluationExplainer):
         timings['total_duration'] = end_time - start_time
         statistics['oracle_calls'] = oracle_calls
         statistics['candidate_size'] = len(sampler.subgraph)
-        statistics['candidates'] = sampler.subgraph[COL_ID].to_numpy()
+        statistics['candidates'] = sampler.event_ids
         cf_ex = best_cf_example.to_cf_example()
         eval_cf_example = EvaluationCounterFactualExample(explained_event_id=explained_event_id,
                                                           original_prediction=original_prediction,
@@ -351,15 +365,18 @@ class EvaluationCoDy(CoDy, EvaluationExplainer):
 
     def __init__(self, tgnn_wrapper: TGNNWrapper, selection_strategy: str = 'recent', max_steps: int = 300,
                  candidates_size: int = 64, verbose: bool = False, approximate_predictions: bool = True,
-                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None):
+                 pretrained_sampler_parameters: PretrainedSelectionStrategyParameters | None = None,
+                 early_stop: bool = False, prediction_cache: PredictionCache | None = None):
         CoDy.__init__(self, tgnn_wrapper=tgnn_wrapper, selection_strategy=selection_strategy,
                       candidates_size=candidates_size, verbose=verbose, max_steps=max_steps,
                       approximate_predictions=approximate_predictions,
-                      pretrained_sampler_parameters=pretrained_sampler_parameters)
+                      pretrained_sampler_parameters=pretrained_sampler_parameters,
+                      prediction_cache=prediction_cache, early_stop=early_stop)
         EvaluationExplainer.__init__(self, tgnn_wrapper=tgnn_wrapper, selection_strategy=selection_strategy,
                                      candidates_size=candidates_size, sample_size=candidates_size, verbose=verbose,
                                      approximate_predictions=approximate_predictions,
-                                     pretrained_sampler_parameters=pretrained_sampler_parameters)
+                                     pretrained_sampler_parameters=pretrained_sampler_parameters,
+                                     prediction_cache=prediction_cache)
         self.last_min_id = -1
 
     def _get_evaluation_subgraph_prediction(self, candidate_events: np.ndarray, node_to_expand: CoDyTreeNode,
@@ -383,15 +400,15 @@ class EvaluationCoDy(CoDy, EvaluationExplainer):
 
     def _run_node_expansion(self, explained_edge_id: int, node_to_expand: CoDyTreeNode, sampler: SelectionStrategy):
         prediction, oracle_call_time, cache_save_time = (
-            self._get_evaluation_subgraph_prediction(candidate_events=sampler.subgraph[COL_ID].to_numpy(),
+            self._get_evaluation_subgraph_prediction(candidate_events=sampler.event_ids,
                                                      node_to_expand=node_to_expand,
                                                      explained_event_id=explained_edge_id,
                                                      memory_label=EXPLAINED_EVENT_MEMORY_LABEL))
         self._expand_node(explained_edge_id, node_to_expand, prediction, sampler)
         return oracle_call_time, cache_save_time
 
-    def evaluate_explanation(self, explained_event_id: int, original_prediction: float) -> (
-            EvaluationCounterFactualExample):
+    def evaluate_explanation(self, explained_event_id: int, original_prediction: float,
+                             deadline: float | None = None) -> EvaluationCounterFactualExample:
         if original_prediction is None:
             original_prediction, sampler = self.initialize_explanation(explained_event_id)
         else:
@@ -438,6 +455,11 @@ class EvaluationCoDy(CoDy, EvaluationExplainer):
         timings['init_duration'] = init_end_time - start_time
         progress_bar = ProgressBar(self.max_steps)
         while step <= self.max_steps and not skip_search:
+            if deadline is not None and time.time() > deadline:
+                statistics['deadline_reached'] = True
+                if self.verbose:
+                    self.logger.info('Time limit reached. Concluding search.')
+                break
             progress_bar.next()
             node_to_expand = None
             while node_to_expand is None:
@@ -449,10 +471,10 @@ class EvaluationCoDy(CoDy, EvaluationExplainer):
                     continue
                 if node_to_expand == root_node and root_node.expanded:
                     break  # No nodes are selectable, meaning that we can conclude the search
-                if node_to_expand.hash() in self.known_states.keys():
+                if node_to_expand.sorted_edge_ids in self.known_states:
                     # Already encountered this combination -> select new combination of events instead
-                    self._expand_node(explained_event_id, node_to_expand, self.known_states[node_to_expand.hash()],
-                                      sampler)
+                    self._expand_node(explained_event_id, node_to_expand,
+                                      self.known_states[node_to_expand.sorted_edge_ids], sampler)
                     node_to_expand = None
             if node_to_expand == root_node and root_node.expanded:
                 if self.verbose:
@@ -487,13 +509,17 @@ class EvaluationCoDy(CoDy, EvaluationExplainer):
                 if self.verbose:
                     self.logger.info(f'Found counterfactual explanation: '
                                      + str(node_to_expand.to_cf_example()))
+            if self._should_stop_early(best_cf_example):
+                if self.verbose:
+                    self.logger.info('Best counterfactual explanation is minimal. Concluding search.')
+                break
             step += 1
         if best_cf_example is None:
             best_cf_example = find_best_non_cf_example(root_node)
             best_cf_example_step = step
         self.tgnn.remove_memory_backup(EXPLAINED_EVENT_MEMORY_LABEL)
         self.tgnn.reset_model()
-        self.known_states = {}
+        self._reset_known_states()
         progress_bar.close()
         end_time = time.time_ns()
         timings['oracle_call_duration'] = oracle_call_time
@@ -501,7 +527,7 @@ class EvaluationCoDy(CoDy, EvaluationExplainer):
         timings['total_duration'] = end_time - start_time + cache_saved_oracle_call_time
         statistics['oracle_calls'] = oracle_calls
         statistics['candidate_size'] = len(sampler.subgraph)
-        statistics['candidates'] = sampler.subgraph[COL_ID].to_numpy()
+        statistics['candidates'] = sampler.event_ids
         statistics['cf_example_step'] = best_cf_example_step
         statistics['first_example_step'] = first_example_step
         statistics['encountered_cf_examples'] = encountered_cf_examples
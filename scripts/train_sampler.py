@@ -15,7 +15,7 @@ from cody.selection import create_embedding_model
 from common import (create_dataset_from_args, create_tgn_wrapper_from_args, add_dataset_arguments,
                     add_wrapper_model_arguments, parse_args)
 
-from cody.constants import EXPLAINED_EVENT_MEMORY_LABEL, CUR_IT_MIN_EVENT_MEM_LBL, COL_ID
+from cody.constants import EXPLAINED_EVENT_MEMORY_LABEL, CUR_IT_MIN_EVENT_MEM_LBL
 from cody.data import TrainTestDatasetParameters
 from scripts.evaluation_explainers import EvaluationExplainer
 from cody.explainer.base import calculate_prediction_delta
@@ -47,7 +47,7 @@ def extract_training_data(explainer: EvaluationExplainer, emb: Embedding, epoch_
         if len(sampler.subgraph) == 0:
             continue
 
-        min_event_id = sampler.subgraph[COL_ID].min() - 1
+        min_event_id = sampler.min_event_id
 
         removed_events = []
 